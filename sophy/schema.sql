@@ -146,10 +146,141 @@ CREATE TABLE IF NOT EXISTS taxonomy (
     modified TEXT
 ) STRICT;
 
+-- every taxon of taxonomy with each of its ranks (depth 0 is the taxon itself, 1 its closest ancestor, ...)
+-- ancestor_id is the AphiaID of the ancestor in the WoRMS cache, a negative id derived from rank and name otherwise
+CREATE TABLE IF NOT EXISTS taxonomy_closure (
+    aphia_id INTEGER NOT NULL,
+    rank TEXT NOT NULL,
+    ancestor_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (aphia_id, rank)
+) STRICT, WITHOUT ROWID;
+-- the primary key covers rank roll-ups of sample_amount/occurrence, these cover descendant and name lookups
+CREATE INDEX IF NOT EXISTS taxonomy_closure_ancestor_id ON taxonomy_closure (ancestor_id, depth);
+CREATE INDEX IF NOT EXISTS taxonomy_closure_rank_name ON taxonomy_closure (rank, name, ancestor_id);
+
 CREATE TABLE IF NOT EXISTS metadata (
     table_name TEXT,
     column_name TEXT,
     data_type TEXT,
     units TEXT,
     description TEXT
- ) STRICT;
\ No newline at end of file
+ ) STRICT;
+
+-- indexes for the common queries (samples.sql) and Datasette facets
+CREATE INDEX IF NOT EXISTS sample_date_time ON sample (date_time);
+CREATE INDEX IF NOT EXISTS sample_zone_sector ON sample (front_zone, sector);
+CREATE INDEX IF NOT EXISTS sample_source_name ON sample (source_name);
+CREATE INDEX IF NOT EXISTS occurrence_date_time ON occurrence (date_time);
+CREATE INDEX IF NOT EXISTS occurrence_zone_sector ON occurrence (front_zone, sector);
+CREATE INDEX IF NOT EXISTS occurrence_source_name ON occurrence (source_name);
+CREATE INDEX IF NOT EXISTS occurrence_aphia_id ON occurrence (aphia_id);
+CREATE INDEX IF NOT EXISTS sample_amount_sample_id ON sample_amount (sample_id);
+CREATE INDEX IF NOT EXISTS sample_amount_aphia_id ON sample_amount (aphia_id);
+
+-- spatial indexes for bounding box queries, id is the sample/occurrence id. R*Tree bounds are 32-bit floats rounded
+-- outwards, join with the table and filter on latitude/longitude again when exact bounds matter
+CREATE VIRTUAL TABLE IF NOT EXISTS sample_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE IF NOT EXISTS occurrence_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon);
+CREATE TRIGGER IF NOT EXISTS sample_rtree_insert AFTER INSERT ON sample
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+BEGIN
+    INSERT INTO sample_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+CREATE TRIGGER IF NOT EXISTS sample_rtree_delete AFTER DELETE ON sample
+BEGIN
+    DELETE FROM sample_rtree WHERE id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS occurrence_rtree_insert AFTER INSERT ON occurrence
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+BEGIN
+    INSERT INTO occurrence_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+CREATE TRIGGER IF NOT EXISTS occurrence_rtree_delete AFTER DELETE ON occurrence
+BEGIN
+    DELETE FROM occurrence_rtree WHERE id = old.id;
+END;
+
+-- columns not in sophy but present in the source dataset, in long format (build.py --extras_table)
+CREATE TABLE IF NOT EXISTS extra (
+    table_name TEXT,
+    row_id INTEGER,
+    key TEXT,
+    value ANY
+) STRICT;
+CREATE INDEX IF NOT EXISTS extra_key ON extra (table_name, key);
+CREATE INDEX IF NOT EXISTS extra_row ON extra (table_name, row_id);
+
+-- aggregates of sample/occurrence rows, updated by build.py as datasets are added and removed. Missing keys are ''
+-- entries per month, zone, sector and source
+CREATE TABLE IF NOT EXISTS agg_count (
+    table_name TEXT NOT NULL,
+    year_month TEXT NOT NULL,
+    front_zone TEXT NOT NULL,
+    sector TEXT NOT NULL,
+    source_name TEXT NOT NULL,
+    entries INTEGER NOT NULL,
+    PRIMARY KEY (table_name, year_month, front_zone, sector, source_name)
+) STRICT, WITHOUT ROWID;
+
+-- count and sum of every measured (REAL) sample column per month, zone, sector and source
+CREATE TABLE IF NOT EXISTS agg_sample_value (
+    variable TEXT NOT NULL,
+    year_month TEXT NOT NULL,
+    front_zone TEXT NOT NULL,
+    sector TEXT NOT NULL,
+    source_name TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (variable, year_month, front_zone, sector, source_name)
+) STRICT, WITHOUT ROWID;
+
+-- sample_amount and occurrence rows per taxon, zone and sector
+CREATE TABLE IF NOT EXISTS agg_taxon_count (
+    aphia_id INTEGER NOT NULL,
+    front_zone TEXT NOT NULL,
+    sector TEXT NOT NULL,
+    amounts INTEGER NOT NULL,
+    occurrences INTEGER NOT NULL,
+    PRIMARY KEY (aphia_id, front_zone, sector)
+) STRICT, WITHOUT ROWID;
+
+CREATE VIEW IF NOT EXISTS sample_mean AS
+SELECT variable, year_month, front_zone, sector, source_name, n, total / n AS mean
+FROM agg_sample_value;
+
+CREATE VIEW IF NOT EXISTS taxon_rank_count AS
+SELECT rank, name AS taxon, front_zone, sector, sum(amounts) AS amounts, sum(occurrences) AS occurrences
+FROM agg_taxon_count JOIN taxonomy_closure USING (aphia_id)
+GROUP BY rank, ancestor_id, front_zone, sector;
+
+-- nearest sample of each occurrence within the tolerances of matching.py (LINK_DISTANCE, LINK_TIME), rebuilt by
+-- build.py whenever the occurrences or samples change
+CREATE TABLE IF NOT EXISTS occurrence_sample (
+    occurrence_id INTEGER PRIMARY KEY REFERENCES occurrence(id),
+    sample_id INTEGER NOT NULL REFERENCES sample(id),
+    distance REAL NOT NULL,
+    time_difference REAL,
+    depth_difference REAL
+) STRICT;
+CREATE INDEX IF NOT EXISTS occurrence_sample_sample_id ON occurrence_sample (sample_id);
+
+-- datasets loaded by build.py, used for incremental builds
+CREATE TABLE IF NOT EXISTS build_manifest (
+    dataset TEXT PRIMARY KEY,
+    sample_hash TEXT,
+    sample_amount_hash TEXT,
+    occurrence_hash TEXT,
+    sample_min_id INTEGER,
+    sample_max_id INTEGER,
+    occurrence_min_id INTEGER,
+    occurrence_max_id INTEGER,
+    built TEXT
+) STRICT;
+
+-- hashes of build inputs shared by all datasets (schema, metadata, WoRMS cache, zones)
+CREATE TABLE IF NOT EXISTS build_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) STRICT;
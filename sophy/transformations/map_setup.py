@@ -19,7 +19,9 @@ import cartopy                                         # to make map
 import cartopy.crs           as     ccrs               # for map projection
 import cartopy.feature       as     cfeature           # to add land features to map
 from   scipy.ndimage         import gaussian_filter    # for adding bathymetry
-import shapefile
+import sys
+sys.path.append('../utils')
+from   zones                 import front_coordinates  # cached front geometries (see utils/make_shapefiles.py)
 
 import geopandas             as     gpd                # for adding shapefiles of frontal zones 
 import pyproj
@@ -227,14 +229,14 @@ def add_fronts(
     ######  Front data  #######################################################
 # '/Users/hannah/Documents/UW-PMEL/Research/sophy_main_repo/sophy/data/shapefiles/fronts'
 # '/Users/hannah/Documents/UW-PMEL/Research/sophy_main_repo/sophy/sophy/transformations'
-    so_fronts = shapefile.Reader('../../data/shapefiles/fronts/so_fronts.shp')
+    so_fronts = front_coordinates('../../data/shapefiles/fronts/so_fronts.shp')
     # stf_mod   = shapefile.Reader('../../data/shapefiles/fronts/stf_mod/stf_mod.shp')
 
-    stf  = so_fronts.shape(0).points
-    saf  = so_fronts.shape(1).points
-    pf   = so_fronts.shape(2).points
-    sacc = so_fronts.shape(3).points
-    sie  = so_fronts.shape(4).points
+    stf  = so_fronts['STF']
+    saf  = so_fronts['SAF']
+    pf   = so_fronts['PF']
+    sacc = so_fronts['SACC']
+    sie  = so_fronts['SIE']
     
     
     
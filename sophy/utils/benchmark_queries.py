@@ -0,0 +1,107 @@
+"""Times the queries of samples.sql on a copy of the database with and without the indexes of schema.sql"""
+
+import os
+import re
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+QUERIES_FILE = "samples.sql"
+DEFAULT_DB_PATH = "../../sophy.db"
+
+
+def read_queries(queries_file: str) -> list[tuple[str, str]]:
+    """(name, sql) of every select statement of a .sql file. The name is the comment above the statement"""
+    queries, statement, name = [], "", None
+    for line in open(queries_file, "r"):
+        if not statement.strip():
+            if line.startswith("--"):
+                name = name or line.strip("- \n")
+            statement = ""
+            if not line.strip():
+                # a comment separated by a blank line is not the name of the next statement
+                name = None
+            if line.startswith("--") or not line.strip():
+                continue
+        statement += line
+        if sqlite3.complete_statement(statement):
+            sql = statement.strip()
+            if re.match(r"(select|with)\b", sql, flags=re.IGNORECASE):
+                queries.append((name or " ".join(sql.split())[:60], sql))
+            statement, name = "", None
+    return queries
+
+
+def scale_database(con: sqlite3.Connection, scale: int):
+    """Appends scale - 1 copies of every sample (with its sample_amount rows) and occurrence"""
+    for table in ("sample", "occurrence"):
+        cols = [row[1] for row in con.execute(f"PRAGMA table_info({table})") if row[1] != "id"]
+        offset = con.execute(f"SELECT coalesce(max(id), 0) FROM {table}").fetchone()[0]
+        for copy in range(1, scale):
+            con.execute(f"INSERT INTO {table} (id, {', '.join(cols)}) "
+                        f"SELECT id + {copy * offset}, {', '.join(cols)} FROM {table} WHERE id <= {offset}")
+            if table == "sample":
+                amount_cols = [row[1] for row in con.execute("PRAGMA table_info(sample_amount)") if row[1] != "sample_id"]
+                con.execute(f"INSERT INTO sample_amount (sample_id, {', '.join(amount_cols)}) "
+                            f"SELECT sample_id + {copy * offset}, {', '.join(amount_cols)} FROM sample_amount "
+                            f"WHERE sample_id <= {offset}")
+    con.commit()
+
+
+def drop_indexes(con: sqlite3.Connection):
+    """Drops the secondary indexes, spatial indexes and their triggers (the database before schema.sql had them)"""
+    for kind, name in con.execute("SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') "
+                                  "AND name NOT LIKE 'sqlite_autoindex%'").fetchall():
+        con.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+    for (name,) in con.execute("SELECT name FROM sqlite_master WHERE sql LIKE 'CREATE VIRTUAL%'").fetchall():
+        con.execute(f"DROP TABLE IF EXISTS {name}")
+    con.commit()
+
+
+def time_query(con: sqlite3.Connection, sql: str, repeat: int) -> float | None:
+    """Best time (seconds) of repeat runs of a query, None if it doesn't run on this database"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            con.execute(sql).fetchall()
+        except sqlite3.OperationalError:
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(db_path: str, queries_file: str = QUERIES_FILE, scale: int = 1, repeat: int = 5) -> list[tuple]:
+    """(name, seconds without indexes, seconds with indexes) of every query of queries_file"""
+    queries = read_queries(queries_file)
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, os.path.basename(db_path))
+        shutil.copy(db_path, copy)
+        con = sqlite3.connect(copy)
+        scale_database(con, scale)
+        con.execute("ANALYZE")
+        after = [time_query(con, sql, repeat) for _, sql in queries]
+        drop_indexes(con)
+        con.execute("ANALYZE")
+        before = [time_query(con, sql, repeat) for _, sql in queries]
+        con.close()
+    return [(name, seconds_before, seconds_after)
+            for (name, _), seconds_before, seconds_after in zip(queries, before, after)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the samples.sql queries with and without indexes")
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH, help="Database to benchmark (not modified)")
+    parser.add_argument("--queries", default=QUERIES_FILE, help="File of the queries to time")
+    parser.add_argument("--scale", type=int, default=1, help="Copies of every sample and occurrence to time with")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per query (the best is reported)")
+    args = parser.parse_args()
+
+    print(f"{'query':<60} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, before, after in benchmark(args.db, args.queries, args.scale, args.repeat):
+        fmt = lambda seconds: "n/a" if seconds is None else f"{seconds * 1000:.2f}"
+        speedup = f"{before / after:.1f}x" if before is not None and after else ""
+        print(f"{name[:60]:<60} {fmt(before):>10} {fmt(after):>10} {speedup:>8}")
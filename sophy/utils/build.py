@@ -2,32 +2,58 @@
 __author__ = "Ayush Nag"
 
 import os
+import re
 import json
+import hashlib
 import sqlite3
+import functools
+import contextlib
 import pyworms
 import argparse
 import logging
 import datetime
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
-import geopandas as gpd
-import cartopy.crs as ccrs
+from concurrent.futures import ProcessPoolExecutor
+from zones import zone_labeler, sea_ice_stack, SEA_ICE_HEADER_FILE
+from export import export_parquet, export_excel, EXPORT_TABLES, PARQUET_TABLES
+from presence import export_presence
+from matching import link_occurrence_samples
 
 LOG_FILE_DIR = "_resources/logs/"
 MODIFIED_DATA_DIR = "../../data/datasets/modified/"
-WORMS_CACHE_FILE = "_resources/worms.json"
+WORMS_CACHE_FILE = "_resources/worms.db"
+WORMS_JSON_FILE = "_resources/worms.json"  # old cache format, imported into WORMS_CACHE_FILE once
 METADATA_FILE = "../metadata.csv"
 ZONES_SHAPEFILE = "../../data/shapefiles/zones/so_zones.shp"
 SOPHY_XLSX_PATH = "../../sophy.xlsx"
 SOPHY_DB_PATH = "../../sophy.db"
 SOPHY_DEBUG_DB_PATH = "sophytest.db"
 SOPHY_DEBUG_XLSX_PATH = "sophytest.xlsx"
+SOPHY_PARQUET_PATH = "../../sophy_parquet/"
+SOPHY_DEBUG_PARQUET_PATH = "sophytest_parquet/"
+SOPHY_PRESENCE_PATH = "../../data/maxent_src/in/sophy_presence_processed/"
+SOPHY_DEBUG_PRESENCE_PATH = "sophytest_presence/"
 SCHEMA_FILE = "../schema.sql"
+# Tables used by the build itself. They are not part of the published data (metadata.csv, sophy.xlsx)
+BUILD_TABLES = ("build_manifest", "build_info")
+# Bulk builds write to this file next to the database and replace the database with it once complete
+BULK_SUFFIX = ".bulk.tmp"
+INSERT_BATCH_ROWS = 10000
+# R*Tree indexes of schema.sql, they (and their shadow tables) are maintained by triggers
+SPATIAL_INDEX_TABLES = ("sample_rtree", "occurrence_rtree")
+# Group keys of the aggregate tables, missing values are '' so every group has one row
+AGGREGATE_KEYS = ("coalesce(strftime('%Y-%m', date_time), '')", "coalesce(front_zone, '')", "coalesce(sector, '')",
+                  "coalesce(source_name, '')")
 WORMS_SQL = {"AphiaID": "aphia_id", "scientificname": "scientific_name", "authority": "authority",
              "superkingdom": "superkingdom", "kingdom": "kingdom", "phylum": "phylum", "subphylum": "subphylum",
              "superclass": "superclass", "class": "class", "subclass": "subclass", "superorder": "superorder",
              "order": "order_", "suborder": "suborder", "infraorder": "infraorder", "superfamily": "superfamily",
              "family": "family", "genus": "genus", "species": "species", "modified": "modified"}
+# Rank fields of WoRMS records from the highest to the lowest rank
+WORMS_RANKS = ("superkingdom", "kingdom", "phylum", "subphylum", "superclass", "class", "subclass", "superorder", "order",
+               "suborder", "infraorder", "superfamily", "family", "genus", "species")
 
 
 def get_table_cols(table: str) -> tuple[str]:
@@ -38,75 +64,78 @@ def get_table_cols(table: str) -> tuple[str]:
 def main():
     """Main function for building the database"""
     # Find all the dataset directories (e.g. modified/lter2022/)
-    data_directories = [name for name in os.listdir(MODIFIED_DATA_DIR)
-                        if os.path.isdir(os.path.join(MODIFIED_DATA_DIR, name))]
-    pbar = tqdm(data_directories, position=0, leave=True)
-    for dataset in pbar:
-        pbar.set_description(f"Processing {dataset}")
-        logger.info(f"Processing {dataset}")
-
-        sample_amount_path = os.path.join(MODIFIED_DATA_DIR, dataset, f"{dataset}_sample_amount.csv")
-        sample_path = os.path.join(MODIFIED_DATA_DIR, dataset, f"{dataset}_sample.csv")
-        occurrence_path = os.path.join(MODIFIED_DATA_DIR, dataset, f"{dataset}_occurrence.csv")
-
-        # SAMPLE_AMOUNT
-        if os.path.exists(sample_amount_path):
-            df = pd.read_csv(sample_amount_path)
-            assert os.path.exists(sample_path), f"{sample_amount_path} found, required file {sample_path} not found"
-            assert "sample_id" in df.columns and not df["sample_id"].hasnans, f"{sample_amount_path}: sample_id column doesn't exist or contains NaN values"
-            # convert df local sample_id to global sample_id
-            # if result is empty, set max_id to 0
-            max_id: int = cur.execute("SELECT MAX(id) from sample").fetchone()[0]
-            if max_id is None:
-                max_id = 0
-            df["sample_id"] = df["sample_id"] + max_id
-            worms_res = query_worms(df["taxa"].unique())
-            # join the worms_res with the df
-            df = df.merge(worms_res, left_on="taxa", right_on="scientific_name", how="left")
-            # keep only the columns that are in the schema
-            df = df.filter(get_table_cols("sample_amount"))
-            affected = df.to_sql("sample_amount", con=con, index=False, if_exists="append")
-            logger.info(f"Added {affected} rows to sample_amount table from {dataset}")
-            con.commit()
-        # SAMPLE
-        if os.path.exists(sample_path):
-            df = pd.read_csv(sample_path)
-            df = geolabel_zones_sectors(df, "latitude", "longitude")
-            df = json_compress(df, table="sample")
-            affected = df.to_sql("sample", con=con, index=False, if_exists="append")
-            logger.info(f"Added {affected} rows to sample table from {dataset}")
-            con.commit()
-        # OCCURRENCE
-        if os.path.exists(occurrence_path):
-            df = pd.read_csv(occurrence_path)
-            worms_res = query_worms(df["taxa"].unique())
-            df = df.merge(worms_res, left_on="taxa", right_on="scientific_name", how="left")
-            df = geolabel_zones_sectors(df, "latitude", "longitude")
-            df = json_compress(df, table="occurrence")
-            affected = df.to_sql("occurrence", con=con, index=False, if_exists="append")
-            logger.info(f"Added {affected} rows to occurrence table from {dataset}")
-            con.commit()
+    data_directories = sorted(name for name in os.listdir(MODIFIED_DATA_DIR)
+                              if os.path.isdir(os.path.join(MODIFIED_DATA_DIR, name)))
+    manifest = {row["dataset"]: dict(row) for row in cur.execute("SELECT * FROM build_manifest").fetchall()}
+    hashes = {dataset: dataset_hashes(dataset) for dataset in data_directories}
+    # Remove datasets that were deleted from the modified/ directory
+    for dataset in manifest.keys() - hashes.keys():
+        logger.info(f"Removing {dataset} (no longer in {MODIFIED_DATA_DIR})")
+        delete_dataset(manifest[dataset])
+    # Only (re-)ingest datasets that are new or whose csv files changed since the last build
+    changed = [dataset for dataset in data_directories
+               if dataset not in manifest or any(manifest[dataset][key] != value for key, value in hashes[dataset].items())]
+    logger.info(f"{len(changed)} of {len(data_directories)} datasets changed since the last build")
+    # WoRMS is queried once for all changed datasets, workers only read the filled cache
+    cache = load_worms_cache()
+    taxa = collect_taxa(changed)
+    if len(taxa) > 0:
+        query_worms(taxa, cache)
+    table_cols = {table: get_table_cols(table) for table in ("sample", "sample_amount", "occurrence")}
+    transform = functools.partial(transform_dataset, table_cols=table_cols, cache=cache, extras_table=args.extras_table,
+                                  sea_ice_dir=args.monthly_sea_ice)
+    # The zone raster and geometry caches are built once here, before the workers start, so they only read them
+    if len(changed) > 0:
+        zone_labeler(ZONES_SHAPEFILE)
+    # Datasets are transformed in a process pool. This process is the only writer: it allocates the global ids and
+    # writes datasets in sorted order, so a parallel build writes exactly the same rows as a serial one
+    with ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else contextlib.nullcontext() as pool:
+        transformed = pool.map(transform, changed) if pool is not None else map(transform, changed)
+        pbar = tqdm(zip(changed, transformed), total=len(changed), position=0, leave=True)
+        for dataset, frames in pbar:
+            pbar.set_description(f"Writing {dataset}")
+            if dataset in manifest:
+                delete_dataset(manifest[dataset])
+            write_dataset(dataset, frames, hashes[dataset])
+            # a bulk load is a single transaction
+            if not args.bulk:
+                con.commit()
+
+    worms_hash = file_hash(WORMS_CACHE_FILE)
+    metadata_hash = file_hash(METADATA_FILE)
+    stale = len(changed) > 0 or len(manifest.keys() - hashes.keys()) > 0
+    if not stale and get_build_info("worms_hash") == worms_hash and get_build_info("metadata_hash") == metadata_hash:
+        print("No changes since the last build")
+        logger.info("No changes since the last build, skipping taxonomy, metadata and export stages")
+        return
 
     # Write stored WoRMS queries to database
     print("Writing WoRMS data to database")
-    result = pd.DataFrame()
-    cache = json.load(open(WORMS_CACHE_FILE, "r"))
-    for taxon, data in cache.items():
-        result = pd.concat([result, pd.DataFrame(data, index=range(len(data)))], ignore_index=True)
-    result = result.rename(columns=WORMS_SQL)
-    extra = result.columns.difference(get_table_cols("taxonomy"))
-    result = result.drop(columns=list(extra))
-    result = result.drop_duplicates(subset=["aphia_id"])
-    affected = result.to_sql("taxonomy", con=con, index=False, if_exists="append")
+    result = taxonomy_table(cache, get_table_cols("taxonomy"))
+    cur.execute("DELETE FROM taxonomy")
+    affected = insert_rows("taxonomy", result)
     logger.info(f"Added {affected} rows to taxonomy table")
-    con.commit()
+    cur.execute("DELETE FROM taxonomy_closure")
+    affected = insert_rows("taxonomy_closure", taxonomy_closure(cache))
+    logger.info(f"Added {affected} rows to taxonomy_closure table")
+    if not args.bulk:
+        con.commit()
+
+    # Link every occurrence to its nearest sample (KD-tree search of all occurrences at once)
+    print("Linking occurrences to samples")
+    cur.execute("DELETE FROM occurrence_sample")
+    affected = insert_rows("occurrence_sample", link_occurrence_samples(con))
+    logger.info(f"Added {affected} rows to occurrence_sample table")
+    if not args.bulk:
+        con.commit()
 
     # Check for inconsistencies in schema and metadata file
     metadata = pd.read_csv(METADATA_FILE)
     tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
     for table in tables:
-        # Skip sqlite tables and the metadata table
-        if table[0].startswith("sqlite_") or table[0] == "metadata":
+        # Skip sqlite tables, build tables, spatial indexes and the metadata table
+        if (table[0].startswith(("sqlite_", *SPATIAL_INDEX_TABLES)) or table[0] == "metadata"
+                or table[0] in BUILD_TABLES):
             continue
         schema_cols = get_table_cols(table[0])
         metadata_cols = metadata[metadata["table_name"] == table[0]]["column_name"]
@@ -114,37 +143,286 @@ def main():
         diff = set(schema_cols).difference(metadata_cols)
         if len(diff) > 0:
             logger.critical(f"{table[0]} table schema has columns {list(diff)} not found in metadata.csv")
-    metadata.to_sql("metadata", con=con, index=False, if_exists="append")
-
-    # Write the database to an Excel workbook
-    writer = pd.ExcelWriter(sophy_xlsx_out, engine="xlsxwriter")
-    pd.read_sql("SELECT * FROM sample", con=con).to_excel(writer, sheet_name="sample", index=False)
-    pd.read_sql("SELECT * FROM sample_amount", con=con).to_excel(writer, sheet_name="sample_amount", index=False)
-    pd.read_sql("SELECT * FROM occurrence", con=con).to_excel(writer, sheet_name="occurrence", index=False)
-    pd.read_sql("SELECT * FROM taxonomy", con=con).to_excel(writer, sheet_name="taxonomy", index=False)
-    pd.read_sql("SELECT * FROM metadata", con=con).to_excel(writer, sheet_name="metadata", index=False)
-    writer.close()
-    print(f"Database written to {sophy_xlsx_out}")
-
-
-def json_compress(df: pd.DataFrame, table: str) -> pd.DataFrame:
-    """Compresses columns not in the schema into a json column"""
-    extra = df.columns.difference(get_table_cols(table))
+    cur.execute("DELETE FROM metadata")
+    insert_rows("metadata", metadata)
+    con.commit()
+    if args.bulk:
+        finish_bulk_load()
+
+    # Export the database tables
+    # Tables are streamed from the database in chunks, memory use doesn't grow with the database
+    if "parquet" in args.export:
+        export_parquet(sophy_db_build, sophy_parquet_out, PARQUET_TABLES)
+        print(f"Database written to {sophy_parquet_out}")
+    if "xlsx" in args.export:
+        export_excel(sophy_db_build, sophy_xlsx_out, EXPORT_TABLES)
+        print(f"Database written to {sophy_xlsx_out}")
+    if "presence" in args.export:
+        counts = export_presence(sophy_db_build, sophy_presence_out)
+        logger.info(f"Exported presence points per season: {counts}")
+        print(f"Seasonal MaxEnt presence points written to {sophy_presence_out}")
+
+    set_build_info("worms_hash", worms_hash)
+    set_build_info("metadata_hash", metadata_hash)
+    con.commit()
+
+
+def dataset_paths(dataset: str) -> dict[str, str]:
+    """Paths of the csv files that make up a dataset, keyed by the table they are loaded into"""
+    return {table: os.path.join(MODIFIED_DATA_DIR, dataset, f"{dataset}_{table}.csv")
+            for table in ("sample", "sample_amount", "occurrence")}
+
+
+def dataset_hashes(dataset: str) -> dict[str, str]:
+    """Content hashes of a dataset's csv files, named like the build_manifest columns"""
+    return {f"{table}_hash": file_hash(path) for table, path in dataset_paths(dataset).items()}
+
+
+def collect_taxa(datasets: list[str]) -> list[str]:
+    """Unique taxa in the sample_amount and occurrence csv files of the provided datasets"""
+    taxa = set()
+    for dataset in datasets:
+        paths = dataset_paths(dataset)
+        for table in ("sample_amount", "occurrence"):
+            if os.path.exists(paths[table]):
+                taxa.update(pd.read_csv(paths[table], usecols=["taxa"])["taxa"].dropna())
+    return sorted(taxa)
+
+
+def transform_dataset(dataset: str, table_cols: dict[str, tuple[str]], cache: dict,
+                      extras_table: bool = False, sea_ice_dir: str = None) -> dict[str, pd.DataFrame]:
+    """Reads and transforms the csv files of a single dataset into rows matching the schema.
+    Doesn't touch the database so it can run in a worker process. Sample and occurrence ids are local (starting at 1).
+    With extras_table, columns not in the schema are returned as long format rows ("sample_extra", "occurrence_extra")
+    instead of extra_json. With sea_ice_dir, SIZ is labelled from the monthly sea ice grids of the directory"""
+    logger.info(f"Processing {dataset}")
+    paths = dataset_paths(dataset)
+    frames = {}
+    # SAMPLE_AMOUNT
+    if os.path.exists(paths["sample_amount"]):
+        df = pd.read_csv(paths["sample_amount"])
+        assert os.path.exists(paths["sample"]), f"{paths['sample_amount']} found, required file {paths['sample']} not found"
+        assert "sample_id" in df.columns and not df["sample_id"].hasnans, f"{paths['sample_amount']}: sample_id column doesn't exist or contains NaN values"
+        worms_res = worms_records(df["taxa"].unique(), cache)
+        # join the worms_res with the df
+        df = df.merge(worms_res, left_on="taxa", right_on="scientific_name", how="left")
+        # keep only the columns that are in the schema
+        frames["sample_amount"] = df.filter(table_cols["sample_amount"])
+    # SAMPLE
+    if os.path.exists(paths["sample"]):
+        df = pd.read_csv(paths["sample"])
+        # local ids start at 1 (row order if the dataset has no id column)
+        if "id" not in df.columns:
+            df["id"] = range(1, len(df) + 1)
+        df = geolabel_zones_sectors(df, "latitude", "longitude", sea_ice_dir)
+        if extras_table:
+            frames["sample"], frames["sample_extra"] = extract_extras(df, table_cols["sample"])
+        else:
+            frames["sample"] = json_compress(df, table_cols["sample"])
+    # OCCURRENCE
+    if os.path.exists(paths["occurrence"]):
+        df = pd.read_csv(paths["occurrence"])
+        df["id"] = range(1, len(df) + 1)
+        worms_res = worms_records(df["taxa"].unique(), cache)
+        df = df.merge(worms_res, left_on="taxa", right_on="scientific_name", how="left")
+        df = geolabel_zones_sectors(df, "latitude", "longitude", sea_ice_dir)
+        if extras_table:
+            frames["occurrence"], frames["occurrence_extra"] = extract_extras(df, table_cols["occurrence"])
+        else:
+            frames["occurrence"] = json_compress(df, table_cols["occurrence"])
+    return frames
+
+
+def write_dataset(dataset: str, frames: dict[str, pd.DataFrame], hashes: dict[str, str]):
+    """Writes the transformed rows of a dataset to the database and records them in build_manifest"""
+    # Global ids are allocated after the largest id ever used (AUTOINCREMENT never reuses ids of deleted rows),
+    # so re-ingesting a dataset can never collide with the ids of another dataset
+    sample_offset, occurrence_offset = next_id_offset("sample"), next_id_offset("occurrence")
+    sample_ids = occurrence_ids = (None, None)
+    if "sample_amount" in frames:
+        # convert df local sample_id to global sample_id
+        df = frames["sample_amount"].assign(sample_id=frames["sample_amount"]["sample_id"] + sample_offset)
+        affected = insert_rows("sample_amount", df)
+        logger.info(f"Added {affected} rows to sample_amount table from {dataset}")
+    if "sample" in frames:
+        df = frames["sample"].assign(id=frames["sample"]["id"] + sample_offset)
+        affected = insert_rows("sample", df)
+        logger.info(f"Added {affected} rows to sample table from {dataset}")
+        sample_ids = (int(df["id"].min()), int(df["id"].max()))
+    if "occurrence" in frames:
+        df = frames["occurrence"].assign(id=frames["occurrence"]["id"] + occurrence_offset)
+        affected = insert_rows("occurrence", df)
+        logger.info(f"Added {affected} rows to occurrence table from {dataset}")
+        occurrence_ids = (int(df["id"].min()), int(df["id"].max()))
+    for table, offset in (("sample", sample_offset), ("occurrence", occurrence_offset)):
+        if f"{table}_extra" in frames:
+            df = frames[f"{table}_extra"]
+            df = df.assign(table_name=table, row_id=df["row_id"] + offset)
+            affected = insert_rows("extra", df)
+            logger.info(f"Added {affected} rows to extra table from {dataset} {table}")
+
+    update_aggregates(sample_ids, occurrence_ids, 1)
+    cur.execute("INSERT OR REPLACE INTO build_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (dataset, hashes["sample_hash"], hashes["sample_amount_hash"], hashes["occurrence_hash"],
+                 *sample_ids, *occurrence_ids, datetime.datetime.now().isoformat()))
+
+
+def insert_rows(table: str, df: pd.DataFrame, batch_rows: int = INSERT_BATCH_ROWS) -> int:
+    """Inserts the rows of a DataFrame with executemany, batch_rows rows at a time (NaN is stored as NULL)"""
+    columns = [f'"{col}"' for col in df.columns]
+    sql = f"INSERT INTO {table} ({csl(columns)}) VALUES ({csl(['?'] * len(columns))})"
+    for start in range(0, len(df), batch_rows):
+        batch = df.iloc[start:start + batch_rows].astype(object)
+        cur.executemany(sql, batch.where(batch.notna(), None).itertuples(index=False, name=None))
+    return len(df)
+
+
+def delete_dataset(entry: dict):
+    """Deletes all rows that were loaded from a dataset, using the id ranges stored in its build_manifest entry"""
+    update_aggregates((entry["sample_min_id"], entry["sample_max_id"]),
+                      (entry["occurrence_min_id"], entry["occurrence_max_id"]), -1)
+    if entry["sample_min_id"] is not None:
+        sample_range = (entry["sample_min_id"], entry["sample_max_id"])
+        cur.execute("DELETE FROM sample_amount WHERE sample_id BETWEEN ? AND ?", sample_range)
+        cur.execute("DELETE FROM extra WHERE table_name = 'sample' AND row_id BETWEEN ? AND ?", sample_range)
+        cur.execute("DELETE FROM sample WHERE id BETWEEN ? AND ?", sample_range)
+    if entry["occurrence_min_id"] is not None:
+        occurrence_range = (entry["occurrence_min_id"], entry["occurrence_max_id"])
+        cur.execute("DELETE FROM occurrence WHERE id BETWEEN ? AND ?", occurrence_range)
+        cur.execute("DELETE FROM extra WHERE table_name = 'occurrence' AND row_id BETWEEN ? AND ?", occurrence_range)
+    cur.execute("DELETE FROM build_manifest WHERE dataset = ?", (entry["dataset"],))
+    logger.info(f"Deleted rows from {entry['dataset']}")
+
+
+def update_aggregates(sample_ids: tuple[int, int], occurrence_ids: tuple[int, int], sign: int):
+    """Adds (sign 1) or subtracts (sign -1) the rows of a dataset's sample and occurrence id ranges to the aggregate
+    tables, so they never have to be recomputed from all rows"""
+    keys = csl(AGGREGATE_KEYS)
+    for table, ids in (("sample", sample_ids), ("occurrence", occurrence_ids)):
+        if ids[0] is None:
+            continue
+        cur.execute(f"INSERT INTO agg_count SELECT '{table}', {keys}, ? * count(*) FROM {table} "
+                    f"WHERE id BETWEEN ? AND ? GROUP BY {keys} ON CONFLICT (table_name, year_month, front_zone, "
+                    f"sector, source_name) DO UPDATE SET entries = entries + excluded.entries", (sign, *ids))
+    if sample_ids[0] is not None:
+        for variable in sample_value_cols():
+            cur.execute(f"INSERT INTO agg_sample_value SELECT '{variable}', {keys}, ? * count({variable}), "
+                        f"? * total({variable}) FROM sample WHERE id BETWEEN ? AND ? AND {variable} IS NOT NULL "
+                        f"GROUP BY {keys} ON CONFLICT (variable, year_month, front_zone, sector, source_name) "
+                        f"DO UPDATE SET n = n + excluded.n, total = total + excluded.total", (sign, sign, *sample_ids))
+        cur.execute("INSERT INTO agg_taxon_count SELECT sample_amount.aphia_id, coalesce(front_zone, ''), "
+                    "coalesce(sector, ''), ? * count(*), 0 FROM sample_amount JOIN sample ON sample.id = sample_amount.sample_id "
+                    "WHERE sample_amount.sample_id BETWEEN ? AND ? AND sample_amount.aphia_id IS NOT NULL GROUP BY 1, 2, 3 "
+                    "ON CONFLICT (aphia_id, front_zone, sector) DO UPDATE SET amounts = amounts + excluded.amounts",
+                    (sign, *sample_ids))
+    if occurrence_ids[0] is not None:
+        cur.execute("INSERT INTO agg_taxon_count SELECT aphia_id, coalesce(front_zone, ''), coalesce(sector, ''), 0, "
+                    "? * count(*) FROM occurrence WHERE id BETWEEN ? AND ? AND aphia_id IS NOT NULL GROUP BY 1, 2, 3 "
+                    "ON CONFLICT (aphia_id, front_zone, sector) DO UPDATE SET occurrences = occurrences + excluded.occurrences",
+                    (sign, *occurrence_ids))
+    # groups of removed datasets
+    cur.execute("DELETE FROM agg_count WHERE entries = 0")
+    cur.execute("DELETE FROM agg_sample_value WHERE n = 0")
+    cur.execute("DELETE FROM agg_taxon_count WHERE amounts = 0 AND occurrences = 0")
+
+
+@functools.cache
+def sample_value_cols() -> list[str]:
+    """Measured sample columns (REAL) that agg_sample_value sums"""
+    return [row["name"] for row in cur.execute("PRAGMA table_info(sample)").fetchall()
+            if row["type"] == "REAL" and row["name"] not in ("latitude", "longitude")]
+
+
+def next_id_offset(table: str) -> int:
+    """Largest id ever allocated in an AUTOINCREMENT table (0 if the table has never had rows)"""
+    row = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def file_hash(path: str) -> str | None:
+    """SHA-256 of a file's contents, None if the file doesn't exist"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_build_info(key: str) -> str | None:
+    """Value stored in the build_info table by the last build (None if missing)"""
+    exists = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='build_info'").fetchone()
+    if exists is None:
+        return None
+    row = cur.execute("SELECT value FROM build_info WHERE key = ?", (key,)).fetchone()
+    return None if row is None else row[0]
+
+
+def set_build_info(key: str, value: str):
+    """Stores a value in the build_info table for the next build"""
+    cur.execute("INSERT OR REPLACE INTO build_info VALUES (?, ?)", (key, value))
+
+
+def json_compress(df: pd.DataFrame, table_cols: tuple[str]) -> pd.DataFrame:
+    """Compresses columns not in the schema (table_cols) into a json column"""
+    extra = df.columns.difference(table_cols)
     logger.warning(f"Compressing columns {list(extra)} into a json column")
-    df["extra_json"] = df[extra].apply(lambda r: r.dropna().to_json(), axis=1)
+    df["extra_json"] = encode_json_rows(df[extra])
     return df.drop(columns=list(extra))
 
 
-def query_worms(taxa: list) -> pd.DataFrame:
-    """Finds full species composition of provided taxa. Uses WoRMS database to find data"""
+def extract_extras(df: pd.DataFrame, table_cols: tuple[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Moves columns not in the schema (table_cols) into long format (row_id, key, value) rows for the extra table.
+    Only non-null values are kept"""
+    extra = df.columns.difference(table_cols)
+    logger.warning(f"Moving columns {list(extra)} into the extra table")
+    long = df[extra].assign(row_id=df["id"]).melt(id_vars="row_id", var_name="key").dropna(subset=["value"])
+    return df.drop(columns=list(extra)), long
+
+
+def encode_json_rows(df: pd.DataFrame) -> pd.Series:
+    """One json object per row without NaN values. Same output as df.apply(lambda r: r.dropna().to_json(), axis=1)
+    but values are encoded one column at a time and the rows are assembled with a single join"""
+    # apply() upcasts the rows of an all numeric frame to a common dtype (e.g. int -> float), mixed rows keep their types
+    numeric = all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in df.dtypes)
+    if numeric and len(df.columns) > 0:
+        df = df.astype(np.result_type(*df.dtypes))
+    rows, fragments = [], []
+    for column in df.columns:
+        values = df[column].dropna()
+        if len(values) == 0:
+            continue
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            # '[value,value,...]' -> '"column":value'
+            key = pd.Series([column]).to_json(orient="values")[1:-1]
+            encoded = np.array(values.to_json(orient="values")[1:-1].split(","), dtype=object)
+            fragments.append(f"{key}:" + encoded)
+        else:
+            # '{"column":value}' lines (strings can contain commas), the braces are stripped to get '"column":value'
+            lines = values.to_frame().to_json(orient="records", lines=True).rstrip("\n").split("\n")
+            fragments.append(np.array([line[1:-1] for line in lines], dtype=object))
+        rows.append(np.flatnonzero(df[column].notna().to_numpy()))
+    result = np.full(len(df), "{}", dtype=object)
+    if len(fragments) > 0:
+        rows, fragments = np.concatenate(rows), np.concatenate(fragments)
+        # order the fragments by row (stable, so columns stay in order) and join them into one string where rows are
+        # separated by "\x1e", which can't appear in encoded json (control characters are escaped)
+        order = np.argsort(rows, kind="stable")
+        rows, fragments = rows[order], fragments[order]
+        last = np.r_[rows[1:] != rows[:-1], True]
+        pieces = np.empty(2 * len(fragments), dtype=object)
+        pieces[0::2], pieces[1::2] = fragments, np.where(last, "}\x1e{", ",")
+        result[rows[last]] = ("{" + "".join(pieces)[:-2]).split("\x1e")
+    return pd.Series(result, index=df.index)
+
+
+def query_worms(taxa: list, cache: dict) -> pd.DataFrame:
+    """Finds full species composition of provided taxa. Uses WoRMS database to find data.
+    New results are added to the loaded cache and appended to the cache database"""
     assert len(taxa) > 0, "No taxa provided"
     # Use the cache to avoid querying the same taxa multiple times (unless user forces requery)
-    if os.path.exists(WORMS_CACHE_FILE) and not args.force_worms:
-        cache = json.load(open(WORMS_CACHE_FILE, "r"))
-        missing = list(set(taxa) - cache.keys())
-    else:
-        cache = {}
-        missing = taxa
+    missing = list(taxa) if args.force_worms else [taxon for taxon in taxa if taxon not in cache]
     # query WoRMS for missing taxa
     if len(missing) > 0:
         logger.info(f"Querying WoRMS for {len(missing)} taxa...")
@@ -154,7 +432,7 @@ def query_worms(taxa: list) -> pd.DataFrame:
         for i, taxon in enumerate(worms):
             # check if a record was not found
             if len(taxon) == 0:
-                logger.critical(f"No record found for '{worms[i]}'")
+                logger.critical(f"No record found for '{missing[i]}'")
             # check if the record is an unaccepted WoRMS name
             elif taxon[0]["status"] == "unaccepted":
                 logger.warning(f"Unaccepted name '{(taxon[0])['scientificname']}' found for '{taxon}'")
@@ -166,42 +444,94 @@ def query_worms(taxa: list) -> pd.DataFrame:
         # replace values in worms with the requery results
         for i, requery_result in requeries.items():
             worms[i] = [requery_result]
-        # cache json format: {"user_input": {worms_result_json}}
-        for i, taxon in enumerate(missing):
-            if len(worms[i]) > 0:
-                cache[taxon] = worms[i][0]
-            else:
-                cache[taxon] = {}
-        # write direct WoRMS results to cache
-        json.dump(cache, open(WORMS_CACHE_FILE, "w+"))
-    # return matching records from the cache
-    cache = json.load(open(WORMS_CACHE_FILE, "r"))
+        # cache format: {"user_input": {worms_result_json}}
+        results = {taxon: worms[i][0] if len(worms[i]) > 0 else {} for i, taxon in enumerate(missing)}
+        cache.update(results)
+        # append direct WoRMS results to the cache database
+        worms_con = sqlite3.connect(WORMS_CACHE_FILE)
+        insert_worms_records(worms_con, results)
+        worms_con.commit()
+        worms_con.close()
+    return worms_records(taxa, cache)
+
+
+def taxonomy_table(cache: dict, table_cols: tuple[str]) -> pd.DataFrame:
+    """Builds the taxonomy table from all records in the WoRMS cache in a single pass"""
+    records = [record for record in cache.values() if len(record) > 0]
+    result = pd.DataFrame.from_records(records).rename(columns=WORMS_SQL)
+    # keep only the columns that are in the schema, one row per AphiaID
+    return result.filter(table_cols).drop_duplicates(subset=["aphia_id"])
+
+
+def taxonomy_closure(cache: dict) -> pd.DataFrame:
+    """Builds the taxonomy_closure table: one row per taxon and rank of its WoRMS record, the taxon itself at depth 0.
+    Ancestors are identified by the AphiaID of the cached record with the same rank and name. Records only have the
+    names of most ancestors, those get a stable negative id hashed from the rank and name"""
+    records = list({record["AphiaID"]: record for record in cache.values() if len(record) > 0}.values())
+    rank_col = lambda rank: WORMS_SQL.get(rank.lower(), rank.lower())
+    # accepted records last, so they are the ancestor of names with several records
+    ancestor_ids = {(rank_col(record["rank"]), record["scientificname"]): record["AphiaID"]
+                    for record in sorted(records, key=lambda record: record.get("status") == "accepted")
+                    if record.get("rank") and record.get("scientificname")}
+    rows = []
+    for record in records:
+        own_rank = rank_col(record["rank"]) if record.get("rank") else None
+        if own_rank is not None and record.get("scientificname"):
+            rows.append((record["AphiaID"], own_rank, record["AphiaID"], record["scientificname"], 0))
+        ancestors = [(WORMS_SQL[rank], record[rank]) for rank in WORMS_RANKS
+                     if record.get(rank) and WORMS_SQL[rank] != own_rank]
+        for depth, (rank, name) in enumerate(reversed(ancestors), start=1):
+            rows.append((record["AphiaID"], rank, ancestor_ids.get((rank, name), taxon_name_id(rank, name)), name, depth))
+    return pd.DataFrame(rows, columns=["aphia_id", "rank", "ancestor_id", "name", "depth"])
+
+
+def taxon_name_id(rank: str, name: str) -> int:
+    """Negative id of a taxon without a WoRMS record, the same in every build"""
+    return -1 - int.from_bytes(hashlib.sha256(f"{rank}:{name}".encode()).digest()[:6], "big")
+
+
+def load_worms_cache() -> dict:
+    """Loads the whole WoRMS cache ({queried name: record}, {} if WoRMS had no record) from the cache database.
+    The cache database has queried names and records keyed by AphiaID. It is created from worms.json on first use"""
+    worms_con = sqlite3.connect(WORMS_CACHE_FILE)
+    worms_con.executescript("""
+        CREATE TABLE IF NOT EXISTS worms_record (aphia_id INTEGER PRIMARY KEY, record TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS worms_query (name TEXT PRIMARY KEY, aphia_id INTEGER REFERENCES worms_record(aphia_id));
+    """)
+    if worms_con.execute("SELECT COUNT(*) FROM worms_query").fetchone()[0] == 0 and os.path.exists(WORMS_JSON_FILE):
+        logger.info(f"Importing {WORMS_JSON_FILE} into {WORMS_CACHE_FILE}")
+        insert_worms_records(worms_con, json.load(open(WORMS_JSON_FILE, "r")))
+        worms_con.commit()
+    rows = worms_con.execute("SELECT q.name, r.record FROM worms_query AS q "
+                             "LEFT JOIN worms_record AS r ON q.aphia_id = r.aphia_id").fetchall()
+    worms_con.close()
+    return {name: {} if record is None else json.loads(record) for name, record in rows}
+
+
+def insert_worms_records(worms_con: sqlite3.Connection, results: dict):
+    """Appends WoRMS results ({queried name: record}) to the cache database, replacing older results of the same name"""
+    records = [(record["AphiaID"], json.dumps(record)) for record in results.values() if len(record) > 0]
+    queries = [(taxon, record.get("AphiaID")) for taxon, record in results.items()]
+    worms_con.executemany("INSERT OR REPLACE INTO worms_record VALUES (?, ?)", records)
+    worms_con.executemany("INSERT OR REPLACE INTO worms_query VALUES (?, ?)", queries)
+
+
+def worms_records(taxa: list, cache: dict) -> pd.DataFrame:
+    """Taxonomy of the provided taxa from an already loaded WoRMS cache (taxa without a record are skipped)"""
     matches = [cache[taxon] for taxon in taxa if taxon in cache and len(cache[taxon]) > 0]
     result = pd.DataFrame(matches)
     # rename the columns to match the schema
     return result.filter(WORMS_SQL.keys()).rename(columns=WORMS_SQL)
 
 
-def geolabel_zones_sectors(df: pd.DataFrame, lat_col: str, lon_col: str) -> pd.DataFrame:
-    """Label the provided dataframe with Southern Ocean zones and sectors based on lon and lat columns"""
-    assert {lon_col, lat_col}.issubset(
-        df.columns), f'"{lon_col}" or "{lat_col}" are not present in the provided DataFrame'
-    assert os.path.exists(
-        ZONES_SHAPEFILE), "missing frontal zones shapefile; see make_shapefiles.py"
-    data_gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon_col], df[lat_col]),
-                                crs="EPSG:4326").to_crs(crs=ccrs.SouthPolarStereo())
-    zones_gdf = gpd.read_file(ZONES_SHAPEFILE).to_crs(ccrs.SouthPolarStereo())
-    # Spatially join data points with zones (polygons) to get labelled data
-    result_gdf = gpd.sjoin(data_gdf, zones_gdf, how="left")
-    df = pd.DataFrame(result_gdf.drop(columns=['geometry', 'index_right']))
+def geolabel_zones_sectors(df: pd.DataFrame, lat_col: str, lon_col: str, sea_ice_dir: str = None) -> pd.DataFrame:
+    """Label the provided dataframe with Southern Ocean zones and sectors based on lon and lat columns.
+    With sea_ice_dir, SIZ is the sea ice extent of the month of each row's date_time (see zones.SeaIceStack)"""
+    sea_ice = sea_ice_stack(sea_ice_dir) if sea_ice_dir else None
+    df = zone_labeler(ZONES_SHAPEFILE).label(df, lat_col, lon_col, sea_ice=sea_ice)
     # warn for data points that are not in any zone
     logger.warning(f"{df["front_zone"].isna().sum()} data points are not in any zone")
-    assert df[lon_col].between(-180, 180).all(), "Data includes longitudes outside of range [-180, 180]"
-    # Labels data by sectors (bins) and their latitude range
-    # Ross Sea sector overlaps with the start and end of range: [-180, 180] so it is defined with two split ranges
-    sectors_series: pd.Series = pd.cut(df[lon_col], bins=[-180, -130, -60, 20, 90, 160, 180],
-                                       labels=['Ross', 'BA', 'Weddell', 'Indian', 'WPO', 'Ross'], ordered=False)
-    return df.assign(sector=sectors_series)
+    return df
 
 
 def run_phytoclass(df: pd.DataFrame, hplc_columns: list[str]) -> pd.DataFrame:
@@ -211,12 +541,38 @@ def run_phytoclass(df: pd.DataFrame, hplc_columns: list[str]) -> pd.DataFrame:
     raise NotImplementedError
 
 
+def split_schema(schema: str) -> tuple[str, str]:
+    """Splits the statements of schema.sql into the tables and the secondary indexes (created after a bulk load)"""
+    index_pattern = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\b[^;]*;", flags=re.IGNORECASE)
+    return index_pattern.sub("", schema), "\n".join(index_pattern.findall(schema))
+
+
+def start_bulk_load():
+    """Relaxes durability for a bulk load: the database file is a temporary copy that is discarded if the build fails"""
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.execute("PRAGMA cache_size = -262144")  # 256 MiB
+
+
+def finish_bulk_load():
+    """Creates the secondary indexes of the loaded tables, then updates the query planner statistics"""
+    cur.executescript(split_schema(open(SCHEMA_FILE, "r").read())[1])
+    cur.execute("ANALYZE")
+    con.commit()
+    if args.vacuum:
+        cur.execute("VACUUM")
+
+
 def empty_database():
     """Deletes all tables in the database. Use with caution!"""
-    tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
+    for view in cur.execute("SELECT name FROM sqlite_master WHERE type='view';").fetchall():
+        cur.execute(f"DROP VIEW {view[0]};")
+    # Virtual tables go first, dropping them drops their shadow tables
+    tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY sql NOT LIKE 'CREATE VIRTUAL%';").fetchall()
     for table in tables:
         if not table[0].startswith("sqlite_"):
-            cur.execute(f"DROP TABLE {table[0]};")
+            cur.execute(f"DROP TABLE IF EXISTS {table[0]};")
     con.commit()
 
 
@@ -225,31 +581,72 @@ def csl(cols: list) -> str:
     return ', '.join(cols)
 
 
-# Set up logging
-logging.basicConfig(filename=f"{LOG_FILE_DIR}build_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log",
-                    filemode='w', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(funcName)s: %(message)s')
 logger = logging.getLogger("sophy")
-parser = argparse.ArgumentParser(description="Utility to build the sophy database")
-parser.add_argument("--debug", action="store_true",
-                    help=f"Enable debug mode (outputs a test database to {SOPHY_DB_PATH})")
-parser.add_argument("--force_worms", action="store_true", help="Force requery of WoRMS database")
-args = parser.parse_args()
-
-sophy_xlsx_out = SOPHY_DEBUG_XLSX_PATH if args.debug else SOPHY_XLSX_PATH
-sophy_db_out = SOPHY_DEBUG_DB_PATH if args.debug else SOPHY_DB_PATH
-
-print(f"Building sophy database... \nDetailed diagnostics at _resources/logs/")
-# Establish database connection
-con = sqlite3.connect(sophy_db_out)
-con.row_factory = sqlite3.Row
-cur = con.cursor()
-# Empty the database
-empty_database()
-# Create new tables
-cur.executescript(open(SCHEMA_FILE, "r").read())
-con.commit()
-# Build the database
-main()
-con.close()
-print("Build complete")
-logger.info("Build complete")
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(filename=f"{LOG_FILE_DIR}build_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log",
+                        filemode='w', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(funcName)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Utility to build the sophy database")
+    parser.add_argument("--debug", action="store_true",
+                        help=f"Enable debug mode (outputs a test database to {SOPHY_DB_PATH})")
+    parser.add_argument("--force_worms", action="store_true", help="Force requery of WoRMS database")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only rebuild datasets whose csv files changed since the last build")
+    parser.add_argument("--extras_table", action="store_true",
+                        help="Store columns not in the schema in the long format extra table instead of extra_json")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes that transform datasets (1 builds serially)")
+    parser.add_argument("--monthly_sea_ice", metavar="DIR",
+                        help="Label SIZ from the monthly NSIDC sea ice grids (YYYYMM in file names) in DIR by sample date")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Full rebuild in a single transaction with relaxed journaling into a temporary file that "
+                             "replaces the database once complete")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the database after a bulk build")
+    parser.add_argument("--export", nargs="*", choices=["parquet", "xlsx", "presence"], default=["parquet", "xlsx"],
+                        help="Export formats of the database tables (Parquet partitioned by source_name and sector). "
+                             "presence writes the seasonal MaxEnt presence points of every class")
+    args = parser.parse_args()
+    if args.bulk and args.incremental:
+        parser.error("--bulk always rebuilds every dataset, it can't be combined with --incremental")
+
+    sophy_xlsx_out = SOPHY_DEBUG_XLSX_PATH if args.debug else SOPHY_XLSX_PATH
+    sophy_db_out = SOPHY_DEBUG_DB_PATH if args.debug else SOPHY_DB_PATH
+    sophy_parquet_out = SOPHY_DEBUG_PARQUET_PATH if args.debug else SOPHY_PARQUET_PATH
+    sophy_presence_out = SOPHY_DEBUG_PRESENCE_PATH if args.debug else SOPHY_PRESENCE_PATH
+
+    print(f"Building sophy database... \nDetailed diagnostics at _resources/logs/")
+    # Establish database connection
+    # A bulk build never touches the previous database until the new one is complete
+    sophy_db_build = sophy_db_out + BULK_SUFFIX if args.bulk else sophy_db_out
+    if args.bulk and os.path.exists(sophy_db_build):
+        os.remove(sophy_db_build)  # left by a failed bulk build
+    con = sqlite3.connect(sophy_db_build)
+    con.row_factory = sqlite3.Row
+    cur = con.cursor()
+    if args.bulk:
+        start_bulk_load()
+    # Empty the database. Incremental builds keep it unless the schema or zones changed (every row would be stale)
+    schema_hash, zones_hash = file_hash(SCHEMA_FILE), file_hash(ZONES_SHAPEFILE)
+    sea_ice_hash = None
+    if args.monthly_sea_ice:
+        # builds the stack cache once before the workers start, its header lists every grid file and mtime
+        sea_ice_stack(args.monthly_sea_ice)
+        sea_ice_hash = file_hash(os.path.join(args.monthly_sea_ice, SEA_ICE_HEADER_FILE))
+    if (not args.incremental or get_build_info("schema_hash") != schema_hash or get_build_info("zones_hash") != zones_hash
+            or get_build_info("sea_ice_hash") != sea_ice_hash):
+        empty_database()
+    # Create new tables. Bulk builds create the indexes after loading the data
+    schema = open(SCHEMA_FILE, "r").read()
+    cur.executescript(split_schema(schema)[0] if args.bulk else schema)
+    set_build_info("schema_hash", schema_hash)
+    set_build_info("zones_hash", zones_hash)
+    set_build_info("sea_ice_hash", sea_ice_hash)
+    con.commit()
+    # Build the database
+    main()
+    con.close()
+    if args.bulk:
+        os.replace(sophy_db_build, sophy_db_out)
+    print("Build complete")
+    logger.info("Build complete")
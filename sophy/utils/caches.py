@@ -0,0 +1,23 @@
+"""Writes the on-disk caches of the build (zone rasters, layer grids, compiled models) so that processes reading
+them never see a partly written file"""
+
+import os
+import tempfile
+import contextlib
+from typing import Iterator
+
+
+@contextlib.contextmanager
+def atomic_write(path: str) -> Iterator[str]:
+    """Path of a temporary file in the directory of path that replaces path (os.replace) when the block exits
+    without an error, and is removed otherwise. The temporary name ends with the name of path, so writers that add
+    an extension (np.save, np.savez) write to it unchanged"""
+    directory, name = os.path.split(path)
+    handle, temp_path = tempfile.mkstemp(prefix=".", suffix=f".{name}", dir=directory or ".")
+    os.close(handle)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,174 @@
+"""Aggregates the in-situ sample variables onto the grid of the BSOSE layers: count, mean, variance and median of each
+variable per grid cell, season and depth bin. Samples are streamed from the database in chunks and merged into
+statistics of the occupied cells only, and the fields are written as memory-mapped rasters with the grid header"""
+
+import os
+import json
+import sqlite3
+import argparse
+import tempfile
+import numpy as np
+from pyproj import Transformer
+from export import connect_readonly, arrow_schema, CHUNK_ROWS
+from rasters import layer_names, load_layer, grid_header, cell_indices, GRID_CRS
+from presence import SEASONS
+from maxent_fit import LAYERS_DIR
+
+DEFAULT_DB_PATH = "../../sophy.db"
+CLIMATOLOGY_DIR = "../../data/climatology/"
+CLIMATOLOGY_HEADER_FILE = "climatology.json"
+CLIMATOLOGY_VARIABLES = ("temperature", "salinity", "nitrate", "chl_a_fluor", "hplc_tot_chl_a", "hplc_fuco",
+                         "hplc_hex_fuco", "hplc_perid")
+STATISTICS = ("count", "mean", "variance", "median")
+# lower edges (m) of the depth bins, the last bin is open (0-50, 50-200, 200+)
+DEPTH_BINS = (0, 50, 200)
+
+
+class CellStatistics:
+    """Count, mean and sum of squared deviations of variables per key (flat index of season, depth bin and grid
+    cell), stored for the occupied keys only (sorted) and merged chunk by chunk with the parallel variance update of
+    Chan et al. The values are also appended to files in spill_dir for the medians"""
+
+    def __init__(self, variables: int, spill_dir: str):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.count, self.mean, self.m2 = (np.zeros((0, variables)) for _ in range(3))
+        self.spill = [(os.path.join(spill_dir, f"{i}.keys"), os.path.join(spill_dir, f"{i}.values"))
+                      for i in range(variables)]
+
+    def add(self, keys: np.ndarray, values: np.ndarray):
+        """Merges the values (rows x variables, NaN is missing) of rows with keys"""
+        chunk_keys, index = np.unique(keys, return_inverse=True)
+        present = ~np.isnan(values)
+        filled = np.where(present, values, 0)
+        count = np.stack([np.bincount(index, present[:, i], len(chunk_keys)) for i in range(values.shape[1])], axis=1)
+        total = np.stack([np.bincount(index, filled[:, i], len(chunk_keys)) for i in range(values.shape[1])], axis=1)
+        mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+        deviation = np.where(present, values - mean[index], 0) ** 2
+        m2 = np.stack([np.bincount(index, deviation[:, i], len(chunk_keys)) for i in range(values.shape[1])], axis=1)
+        # statistics of the union of the keys, the chunk's keys merged into them
+        keys = np.union1d(self.keys, chunk_keys)
+        old, new = np.searchsorted(keys, self.keys), np.searchsorted(keys, chunk_keys)
+        merged = [np.zeros((len(keys), values.shape[1])) for _ in range(3)]
+        for array, part in zip(merged, (self.count, self.mean, self.m2)):
+            array[old] = part
+        merged_count, merged_mean, merged_m2 = merged
+        merged_count[new] += count
+        delta = mean - merged_mean[new]
+        weight = np.divide(count, merged_count[new], out=np.zeros_like(count), where=merged_count[new] > 0)
+        merged_m2[new] += m2 + delta ** 2 * weight * (merged_count[new] - count)
+        merged_mean[new] += delta * weight
+        self.keys, self.count, self.mean, self.m2 = keys, merged_count, merged_mean, merged_m2
+        for i, (keys_file, values_file) in enumerate(self.spill):
+            with open(keys_file, "ab") as file:
+                chunk_keys[index][present[:, i]].tofile(file)
+            with open(values_file, "ab") as file:
+                values[present[:, i], i].tofile(file)
+
+    def variance(self) -> np.ndarray:
+        """Sample variance (keys x variables), NaN with less than 2 values"""
+        return np.divide(self.m2, self.count - 1, out=np.full_like(self.m2, np.nan), where=self.count > 1)
+
+    def medians(self, variable: int) -> tuple[np.ndarray, np.ndarray]:
+        """Keys with values of a variable and their median, from the values spilled to disk (only this variable's
+        values are read)"""
+        keys_file, values_file = self.spill[variable]
+        if not os.path.exists(keys_file):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        keys, values = np.fromfile(keys_file, dtype=np.int64), np.fromfile(values_file, dtype=np.float64)
+        order = np.lexsort((values, keys))
+        keys, values = keys[order], values[order]
+        unique, start, count = np.unique(keys, return_index=True, return_counts=True)
+        return unique, (values[start + (count - 1) // 2] + values[start + count // 2]) / 2
+
+
+def season_grid(layers_dir: str) -> dict:
+    """Grid header and CRS (.prj text) of the layers of every season, which must be on one grid"""
+    header = None
+    for season in SEASONS:
+        layer_dir = os.path.join(layers_dir, season)
+        layer_header = load_layer(layer_dir, layer_names(layer_dir)[0])[1]
+        assert header is None or grid_header(layer_header) == grid_header(header), \
+            f"The {season} layers are not on the grid of the other seasons"
+        header = layer_header
+    return {**grid_header(header), "crs": header["crs"]}
+
+
+def aggregate(db_path: str, out_dir: str = CLIMATOLOGY_DIR, variables: tuple[str] = CLIMATOLOGY_VARIABLES,
+              layers_dir: str = LAYERS_DIR, depth_bins: tuple[float] = DEPTH_BINS,
+              chunk_rows: int = CHUNK_ROWS) -> dict:
+    """Writes the statistics of every variable per season, depth bin and grid cell of the layers to
+    out_dir/<variable>_<statistic>.npy (seasons x depth bins x rows x columns, NaN or count 0 without samples) and
+    their grid header and CRS to out_dir/climatology.json. Samples are read chunk_rows at a time, reprojected to the
+    grid and their cells, seasons (from date_time) and depth bins found in one vectorized pass per chunk. Samples
+    without a date, position or depth or outside the grid are left out. Returns the header"""
+    con = connect_readonly(db_path)
+    columns = arrow_schema(con, "sample").names
+    for variable in variables:
+        assert variable in columns, f"sample has no column {variable}"
+    header = season_grid(layers_dir)
+    cells = header["nrows"] * header["ncols"]
+    transformer = Transformer.from_crs("EPSG:4326", GRID_CRS, always_xy=True)
+    season_of_month = np.full(13, -1)
+    for i, months in enumerate(SEASONS.values()):
+        season_of_month[list(months)] = i
+    quoted = ", ".join(f'"{variable}"' for variable in variables)
+    cursor = con.cursor()
+    cursor.row_factory = None
+    cursor.execute(f"SELECT longitude, latitude, CAST(strftime('%m', date_time) AS INTEGER), depth, {quoted} "
+                   f"FROM sample WHERE longitude IS NOT NULL AND latitude IS NOT NULL AND date_time IS NOT NULL "
+                   f"AND depth IS NOT NULL")
+    with tempfile.TemporaryDirectory() as spill_dir:
+        statistics = CellStatistics(len(variables), spill_dir)
+        while rows := cursor.fetchmany(chunk_rows):
+            rows = np.array(rows, dtype=float)
+            x, y = transformer.transform(rows[:, 0], rows[:, 1])
+            row, col = cell_indices(header, x, y)
+            season = season_of_month[np.nan_to_num(rows[:, 2], nan=0).astype(int)]
+            depth_bin = np.searchsorted(depth_bins, rows[:, 3], side="right") - 1
+            inside = (row >= 0) & (season >= 0) & (depth_bin >= 0)
+            keys = (season * len(depth_bins) + depth_bin) * cells + row * header["ncols"] + col
+            statistics.add(keys[inside], rows[inside, 4:])
+        con.close()
+        os.makedirs(out_dir, exist_ok=True)
+        shape = (len(SEASONS), len(depth_bins), header["nrows"], header["ncols"])
+        variance = statistics.variance()
+        for i, variable in enumerate(variables):
+            fields = {"count": statistics.count[:, i], "mean": statistics.mean[:, i], "variance": variance[:, i]}
+            sampled = fields["count"] > 0
+            for statistic in STATISTICS:
+                dtype = np.int32 if statistic == "count" else np.float32
+                field = np.lib.format.open_memmap(os.path.join(out_dir, f"{variable}_{statistic}.npy"), mode="w+",
+                                                  dtype=dtype, shape=shape)
+                field.fill(0 if statistic == "count" else np.nan)
+                if statistic == "median":
+                    keys, medians = statistics.medians(i)
+                    field.reshape(-1)[keys] = medians
+                else:
+                    field.reshape(-1)[statistics.keys[sampled]] = fields[statistic][sampled]
+                field.flush()
+    header |= {"variables": list(variables), "statistics": list(STATISTICS), "seasons": list(SEASONS),
+               "depth_bins": list(depth_bins)}
+    json.dump(header, open(os.path.join(out_dir, CLIMATOLOGY_HEADER_FILE), "w"))
+    return header
+
+
+def load_climatology(variable: str, statistic: str, out_dir: str = CLIMATOLOGY_DIR) -> tuple[np.ndarray, dict]:
+    """Memory-mapped field (seasons x depth bins x rows x columns) of a statistic of a variable and the header
+    (grid, CRS, seasons, depth bins)"""
+    return (np.load(os.path.join(out_dir, f"{variable}_{statistic}.npy"), mmap_mode="r"),
+            json.load(open(os.path.join(out_dir, CLIMATOLOGY_HEADER_FILE), "r")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grid the sample variables on the BSOSE grid per season and depth")
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH, help="Database to aggregate (not modified)")
+    parser.add_argument("--out", default=CLIMATOLOGY_DIR, help="Directory of the <variable>_<statistic>.npy fields")
+    parser.add_argument("--variables", nargs="*", default=CLIMATOLOGY_VARIABLES, help="sample columns to aggregate")
+    parser.add_argument("--layers", default=LAYERS_DIR, help="Directory of <season>/<variable>.asc layers (the grid)")
+    parser.add_argument("--depth_bins", nargs="*", type=float, default=DEPTH_BINS,
+                        help="Lower edges of the depth bins in m, the last bin is open")
+    parser.add_argument("--chunk_rows", type=int, default=CHUNK_ROWS, help="Samples read from the database at once")
+    args = parser.parse_args()
+
+    aggregate(args.db, args.out, tuple(args.variables), args.layers, tuple(args.depth_bins), args.chunk_rows)
+    print(f"Climatology written to {args.out}")
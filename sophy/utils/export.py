@@ -0,0 +1,159 @@
+"""Streams the tables of the sophy database to Parquet and Excel in bounded chunks (constant memory)"""
+
+import os
+import shutil
+import sqlite3
+from typing import Iterator
+from urllib.parse import quote
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import xlsxwriter
+from xlsxwriter.worksheet import Worksheet
+
+# tables of the Excel workbook
+EXPORT_TABLES = ("sample", "sample_amount", "occurrence", "taxonomy", "metadata")
+# extra (long format, filled by build.py --extras_table) is only exported to Parquet, and only when it has rows
+OPTIONAL_TABLES = ("extra",)
+PARQUET_TABLES = EXPORT_TABLES + OPTIONAL_TABLES
+# Parquet files of tables with these columns are split into source_name=.../sector=... directories
+PARTITION_COLS = ("source_name", "sector")
+HIVE_NULL = "__HIVE_DEFAULT_PARTITION__"
+# sample_amount rows are partitioned by the source_name and sector of their sample
+PARTITION_JOINS = {"sample_amount": ("sample", "sample.id = sample_amount.sample_id")}
+CHUNK_ROWS = 10000
+EXCEL_MAX_ROWS = 1048576
+# Declared column types of schema.sql (also listed in metadata.csv). ANY and untyped columns are exported as text
+ARROW_TYPES = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+
+
+def connect_readonly(db_path: str, cached_statements: int = 128) -> sqlite3.Connection:
+    """Read-only connection to the database that may be used from any (one at a time) thread"""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False,
+                          cached_statements=cached_statements)
+    con.execute("PRAGMA query_only = ON")
+    return con
+
+
+def arrow_schema(con: sqlite3.Connection, table: str) -> pa.Schema:
+    """Arrow schema of a table from the column types declared in schema.sql"""
+    columns = con.execute(f"PRAGMA table_info({table})").fetchall()
+    return pa.schema([(column[1], ARROW_TYPES.get(column[2].upper(), pa.string())) for column in columns])
+
+
+def export_query(con: sqlite3.Connection, table: str) -> tuple[str, pa.Schema, list[str]]:
+    """SELECT statement, Arrow schema and partition columns of the Parquet export of a table"""
+    schema = arrow_schema(con, table)
+    if table in PARTITION_JOINS:
+        joined, condition = PARTITION_JOINS[table]
+        joined_schema = arrow_schema(con, joined)
+        partitions = [name for name in PARTITION_COLS if name in joined_schema.names]
+        columns = [f"{table}.{name}" for name in schema.names] + [f"{joined}.{name}" for name in partitions]
+        schema = pa.schema(list(schema) + [joined_schema.field(name) for name in partitions])
+        return f"SELECT {', '.join(columns)} FROM {table} LEFT JOIN {joined} ON {condition}", schema, partitions
+    partitions = [name for name in PARTITION_COLS if name in schema.names]
+    return f"SELECT {', '.join(schema.names)} FROM {table}", schema, partitions
+
+
+def is_empty(con: sqlite3.Connection, table: str) -> bool:
+    """Whether a table has no rows"""
+    return con.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})").fetchone()[0] == 1
+
+
+def record_batches(con: sqlite3.Connection, query: str, schema: pa.Schema,
+                   chunk_rows: int = CHUNK_ROWS) -> Iterator[pa.RecordBatch]:
+    """Rows of a query as Arrow record batches of at most chunk_rows rows"""
+    cursor = con.cursor()
+    cursor.row_factory = None
+    cursor.execute(query)
+    while rows := cursor.fetchmany(chunk_rows):
+        columns = []
+        for field, values in zip(schema, zip(*rows)):
+            if pa.types.is_string(field.type):
+                # ANY columns hold numbers and text
+                values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+            columns.append(pa.array(values, type=field.type))
+        yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def export_parquet(db_path: str, out_dir: str, tables: tuple[str] = PARQUET_TABLES, chunk_rows: int = CHUNK_ROWS):
+    """Writes every table to out_dir/<table>/ as Parquet, hive partitioned (source_name=.../sector=.../) where the
+    table has the partition columns. Rows are streamed from SQLite chunk_rows at a time and appended to one open
+    file per partition, so memory use doesn't grow with the table. Empty OPTIONAL_TABLES are left out"""
+    con = connect_readonly(db_path)
+    for table in tables:
+        table_dir = os.path.join(out_dir, table)
+        # old partitions may not exist anymore
+        shutil.rmtree(table_dir, ignore_errors=True)
+        if table in OPTIONAL_TABLES and is_empty(con, table):
+            continue
+        query, schema, partitions = export_query(con, table)
+        file_schema = pa.schema([field for field in schema if field.name not in partitions])
+        writers = {}
+        for batch in record_batches(con, query, schema, chunk_rows):
+            for directory, rows in partition_batch(pa.Table.from_batches([batch]), partitions):
+                if directory not in writers:
+                    os.makedirs(os.path.join(table_dir, directory), exist_ok=True)
+                    writers[directory] = pq.ParquetWriter(os.path.join(table_dir, directory, "part-0.parquet"),
+                                                          file_schema)
+                writers[directory].write_table(rows.drop_columns(partitions))
+        if not writers:
+            # empty table, keep its schema
+            os.makedirs(table_dir)
+            pq.write_table(file_schema.empty_table(), os.path.join(table_dir, "part-0.parquet"))
+        for writer in writers.values():
+            writer.close()
+    con.close()
+
+
+def partition_batch(rows: pa.Table, partitions: list[str]) -> Iterator[tuple[str, pa.Table]]:
+    """Hive partition directory (col=value/...) and rows of each distinct partition value of the rows"""
+    if not partitions:
+        yield "", rows
+        return
+    for key in rows.select(partitions).group_by(partitions).aggregate([]).to_pylist():
+        mask = None
+        for name, value in key.items():
+            match = pc.is_null(rows[name]) if value is None else pc.fill_null(pc.equal(rows[name], value), False)
+            mask = match if mask is None else pc.and_(mask, match)
+        directory = os.path.join(*(f"{name}={HIVE_NULL if value is None else quote(str(value), safe='')}"
+                                   for name, value in key.items()))
+        yield directory, rows.filter(mask)
+
+
+def export_excel(db_path: str, path: str, tables: tuple[str] = EXPORT_TABLES,
+                 chunk_rows: int = CHUNK_ROWS):
+    """Writes every table to a sheet of an Excel workbook. Rows are streamed from SQLite chunk_rows at a time and
+    flushed to disk row by row (xlsxwriter constant_memory). Tables longer than the Excel sheet limit continue on
+    <table>_2, <table>_3, ... sheets. Empty OPTIONAL_TABLES get no sheet"""
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_urls": False,
+                                          "nan_inf_to_errors": True})
+    con = connect_readonly(db_path)
+    header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for table in tables:
+        if table in OPTIONAL_TABLES and is_empty(con, table):
+            continue
+        cursor = con.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT * FROM {table}")
+        names = [column[0] for column in cursor.description]
+        sheet, sheets, row = None, 0, EXCEL_MAX_ROWS
+        while rows := cursor.fetchmany(chunk_rows):
+            for values in rows:
+                if row == EXCEL_MAX_ROWS:
+                    sheets += 1
+                    sheet = add_sheet(workbook, table if sheets == 1 else f"{table}_{sheets}", names, header)
+                    row = 1
+                sheet.write_row(row, 0, values)
+                row += 1
+        if sheet is None:
+            add_sheet(workbook, table, names, header)
+    workbook.close()
+    con.close()
+
+
+def add_sheet(workbook: xlsxwriter.Workbook, name: str, columns: list[str], header_format) -> Worksheet:
+    """New worksheet with a header row"""
+    sheet = workbook.add_worksheet(name)
+    sheet.write_row(0, 0, columns, header_format)
+    return sheet
@@ -1,6 +1,10 @@
 """Defines static methods that can be used to interact with Southern Ocean fronts and sectors"""
 __author__ = 'Ayush Nag'
 
+import json
+import inspect
+import hashlib
+import argparse
 from os.path import exists
 import numpy as np
 import pandas as pd
@@ -10,17 +14,24 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import geopandas as gpd
 import pyproj
+import contourpy
 from shapely.geometry import Polygon
 from shapely.ops import transform
 from pyproj import Transformer
 from geopandas import GeoDataFrame
 from pandas import DataFrame, Series
-
-kim_orsi_file: str = '../../data/in/fronts/ys_fronts.mat'
-nsidc_sea_ice_file: str = '../../data/in/sea_ice/mean.sep.1979-2021.s'
-gray_fronts_file: str = '../../data/in/fronts/fronts_Gray.mat'
-fronts_shapefile: str = '../data/in/shapefiles/fronts/so_fronts.shp'
-zones_shapefile: str = '../data/in/shapefiles/zones/so_zones.shp'
+from zones import ZoneLabeler, zone_labeler, read_geometries, NSIDC_SHAPE, NSIDC_X, NSIDC_Y
+
+kim_orsi_file: str = '../../data/fronts/ys_fronts.mat'
+nsidc_sea_ice_file: str = '../../data/sea_ice/mean.sep.1979-2021.s'
+gray_fronts_file: str = '../../data/fronts/fronts_Gray.mat'
+fronts_shapefile: str = '../../data/shapefiles/fronts/so_fronts.shp'
+zones_shapefile: str = '../../data/shapefiles/zones/so_zones.shp'
+# Hashes of the inputs the shapefiles were generated from
+shapefiles_manifest: str = '../../data/shapefiles/manifest.json'
+southern_ocean_lat: float = -29.5
+sie_threshold: int = 15
+land_dataset: str = 'naturalearth_lowres'
 project: Transformer = pyproj.Transformer.from_crs(pyproj.CRS('EPSG:4326'), ccrs.SouthPolarStereo(),
                                                    always_xy=True)
 
@@ -32,7 +43,7 @@ def create_fronts_zones_shapes():
     shapes: dict = {}
     # Roughly represents the Southern Ocean as a circle along latitude = -29.5
     southern_ocean: Polygon = transform(project.transform, Polygon(
-        zip(np.append(np.linspace(start=0, stop=360, num=1000), 0), np.full(1000, -29.5))))
+        zip(np.append(np.linspace(start=0, stop=360, num=1000), 0), np.full(1000, southern_ocean_lat))))
 
     # Create shapely objects for each front
     stf: Polygon = get_stf()
@@ -41,7 +52,7 @@ def create_fronts_zones_shapes():
     orsi_fronts: list = get_orsi_fronts()
     shapes['SAF'], shapes['PF'], shapes['SACC'] = orsi_fronts
 
-    sie: Polygon = get_sie()
+    sie: Polygon = get_sie(threshold=sie_threshold)
     shapes['SIE'] = sie
 
     # Create GeoDataFrame with all fronts, export to ESRI shapefile format
@@ -55,12 +66,40 @@ def create_fronts_zones_shapes():
     names: list = ['STZ', 'SAZ', 'PFZ', 'ASZ', 'SOZ', 'SIZ']
 
     zones_gdf = GeoDataFrame({'front_zone': names, 'geometry': zones}, crs=ccrs.SouthPolarStereo())
-    world: GeoDataFrame = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres")).to_crs(crs=ccrs.SouthPolarStereo())
+    world: GeoDataFrame = gpd.read_file(gpd.datasets.get_path(land_dataset)).to_crs(crs=ccrs.SouthPolarStereo())
     zones_gdf = zones_gdf.overlay(world, how='difference')  # remove land
     zones_gdf.to_file(zones_shapefile)
+    # write the GeoParquet caches that build.py and map_setup.py load instead of the shapefiles
+    read_geometries(fronts_shapefile)
+    read_geometries(zones_shapefile)
     print('Success! Shapefiles generated')
 
 
+def shapefiles_inputs_hash() -> str:
+    """Hash of the input files, parameters and code that create_fronts_zones_shapes() generates the shapefiles from"""
+    digest = hashlib.sha256()
+    for path in (gray_fronts_file, kim_orsi_file, nsidc_sea_ice_file):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    params: dict = {'southern_ocean_lat': southern_ocean_lat, 'sie_threshold': sie_threshold, 'land': land_dataset}
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for func in (create_fronts_zones_shapes, get_stf, get_orsi_fronts, get_sie, sie_polygon):
+        digest.update(inspect.getsource(func).encode())
+    return digest.hexdigest()
+
+
+def update_fronts_zones_shapes(force: bool = False) -> bool:
+    """Regenerates the fronts and zones shapefiles only if an input changed since they were generated (see
+    shapefiles_manifest). Returns whether they were regenerated"""
+    inputs_hash: str = shapefiles_inputs_hash()
+    if not force and exists(shapefiles_manifest) and exists(fronts_shapefile) and exists(zones_shapefile):
+        if json.load(open(shapefiles_manifest, 'r'))['inputs_hash'] == inputs_hash:
+            return False
+    create_fronts_zones_shapes()
+    json.dump({'inputs_hash': inputs_hash}, open(shapefiles_manifest, 'w'))
+    return True
+
+
 def get_stf() -> Polygon:
     """Generates Polygon for the SubTropical Front. Data from Gray et al. 2018"""
     gray_mat: dict = sio.loadmat(gray_fronts_file)
@@ -92,66 +131,43 @@ def get_orsi_fronts() -> list:
     return result
 
 
-def get_sie() -> Polygon:
+def get_sie(sea_ice_file: str = nsidc_sea_ice_file, threshold: int = 15) -> Polygon:
     """Generates Polygon for Sea Ice Concentration.
      Data from NSIDC SMMR and SSM/I-SSMIS v3. Dataset: NSIDC-0192
      Used September mean (1979-2021) for max sea ice extent"""
-    ice = np.fromfile(nsidc_sea_ice_file, dtype=np.uint8)
-    edge: list = []
-    water: bool = True
-    # Select grid cells that define edge of sea ice
-    for i, conc in enumerate(ice):
-        if conc < 100:
-            # (previous cell was water and this one is not) OR (vice versa)
-            if (water and conc >= 15) or (not water and conc == 0):
-                edge.append(i)
-            water = conc == 0
-    dx = dy = 25000  # Space between grid cells = 25km
-    # NSIDC Southern Hemisphere Grid Coordinates (332 rows x 316 cols)
-    x, y = np.arange(-3950000, +3950000, +dx), np.arange(+4350000, -3950000, -dy)
-    # All points in the grid as 104,912 rows, 2 columns. Note: 104,912 = 332 * 316
-    stack_points = np.dstack(np.meshgrid(x, y)).reshape(-1, 2)
-    # Only keep points that define the perimeter
-    edge_points = stack_points[edge].T
-    # Points are in zigzag order because they were inserted as grid cells, not their real order along the perimeter
-    # They need to be projected to EPSG: 4326 where they lay flat and then get sorted by the x-axis (longitude)
-    # Once sorted, the points will connect to make the desired shape
-    flat_points = gpd.points_from_xy(x=edge_points[0], y=edge_points[1], crs=ccrs.SouthPolarStereo()).to_crs(crs='EPSG:4326')
-    # All points defining the perimeter as integer pairs
-    points = np.vstack((flat_points.x, flat_points.y)).T
-    # Sort the points by the x-axis (longitude)
-    sorted_points = points[points[:, 0].argsort()]
-    # Make Polygon and convert to Southern Hemisphere EPSG
-    sie = Polygon(sorted_points)
-    return transform(project.transform, sie)
+    ice = np.fromfile(sea_ice_file, dtype=np.uint8).reshape(NSIDC_SHAPE)
+    return sie_polygon(ice, threshold)
+
+
+def sie_polygon(ice: np.ndarray, threshold: int = 15) -> Polygon:
+    """Polygon enclosed by the sea ice edge of a 332 x 316 NSIDC concentration grid (percent, land >= 253).
+    The edge is the contour between water and ice/land cells, traced as an ordered ring"""
+    # Land and coast are inside the ice edge, so they count as ice
+    mask = (ice >= threshold).astype(np.float64)
+    # contourpy traces the boundary between 0 and 1 cells as closed lines in grid coordinates
+    lines = contourpy.contour_generator(x=NSIDC_X, y=NSIDC_Y, z=mask).lines(0.5)
+    # Small ice patches and polynyas are separate rings, the ice edge is the ring enclosing the largest area
+    rings = [Polygon(line) for line in lines if len(line) >= 4]
+    return max(rings, key=lambda ring: ring.area)
 
 
 def label_zones(data: DataFrame, lon_col: str, lat_col: str) -> DataFrame:
-    """Labels provided data with fronts"""
+    """Labels provided data with fronts. Points that are not in any zone are dropped"""
     assert {lon_col, lat_col}.issubset(
         data.columns), f'"{lon_col}" or "{lat_col}"are not present in the provided DataFrame'
-    assert data[lat_col] <= -30, "Provided latitude is not in the Southern Ocean (must be less than -30 degrees)"
+    assert (data[lat_col] <= -30).all(), "Provided latitude is not in the Southern Ocean (must be less than -30 degrees)"
     assert exists(
         zones_shapefile), 'missing frontal zones shapefile; try running create_fronts_zones_shapes()'
 
-    data_gdf = GeoDataFrame(data, geometry=gpd.points_from_xy(data[lon_col], data[lat_col]), crs='EPSG:4326')
-    data_gdf.to_crs(crs=ccrs.SouthPolarStereo(), inplace=True)
-
-    zones_gdf = gpd.read_file(zones_shapefile).to_crs(ccrs.SouthPolarStereo())
-    # Spatially join data points with zones (polygons) to get labelled data
-    result = gpd.sjoin(data_gdf, zones_gdf)
-    return DataFrame(result.drop(columns='geometry'))
+    zones = zone_labeler(zones_shapefile).label_zones(data[lat_col].to_numpy(), data[lon_col].to_numpy())
+    return data.assign(front_zone=zones).dropna(subset=['front_zone'])
 
 
 def label_sectors(data: DataFrame, lon_col: str) -> DataFrame:
     """Labels provided data with sectors"""
     assert lon_col in data.columns, f'"{lon_col}" is not present in the provided DataFrame'
     assert data[lon_col].between(-180, 180).all(), f"Data includes longitudes outside of range [-180, 180]"
-    # Labels data by sectors (bins) and their latitude range
-    # Ross Sea sector overlaps with the start and end of range: [-180, 180] so it is defined with two split ranges
-    sectors_series: Series = pd.cut(data[lon_col], bins=[-180, -130, -60, 20, 90, 160, 180],
-                                    labels=['Ross', 'BA', 'Weddell', 'Indian', 'WPO', 'Ross'], ordered=False)
-    return data.assign(sector=sectors_series)
+    return data.assign(sector=ZoneLabeler.label_sectors(data[lon_col]))
 
 
 def plot_orsi_fronts():
@@ -194,7 +210,7 @@ def plot_nsidc_sie():
 
     # Credit: Filipe Fernandes (python4oceanographers)
     ice = np.fromfile(nsidc_sea_ice_file, dtype=np.uint8)
-    ice = ice.reshape(332, 316)
+    ice = ice.reshape(NSIDC_SHAPE)
     ice = ice / 250.
     # mask all land and missing values
     ice = np.ma.masked_greater(ice, 1.0)
@@ -203,7 +219,12 @@ def plot_nsidc_sie():
     ax.add_feature(cartopy.feature.LAND)
     ax.gridlines(draw_labels=True)
 
-    dx = dy = 25000
-    x = np.arange(-3950000, +3950000, +dx)
-    y = np.arange(+4350000, -3950000, -dy)
-    ax.pcolormesh(x, y, ice, cmap=plt.cm.Blues, transform=ccrs.SouthPolarStereo())
+    ax.pcolormesh(NSIDC_X, NSIDC_Y, ice, cmap=plt.cm.Blues, transform=ccrs.SouthPolarStereo())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates the Southern Ocean fronts and zones shapefiles")
+    parser.add_argument("--force", action="store_true", help="Regenerate the shapefiles even if no input changed")
+    args = parser.parse_args()
+    if not update_fronts_zones_shapes(args.force):
+        print('Shapefiles are up to date')
@@ -0,0 +1,188 @@
+"""Matches occurrences to the samples around them in space, time and depth, and points to the cells of the BSOSE
+grid. Samples are projected to SouthPolarStereo (the projection of the zones, see zones.py) and put in a KD-tree whose
+time and depth axes are scaled by their tolerances, so every query is one bulk search of the tree instead of a
+comparison with every sample. Distances are geodesic (WGS84)"""
+
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+import cartopy.crs as ccrs
+from scipy.spatial import cKDTree
+from pyproj import Transformer, Geod
+from export import connect_readonly, CHUNK_ROWS
+from rasters import layer_names, load_layer, cell_indices, GRID_CRS
+
+DEFAULT_DB_PATH = "../../sophy.db"
+# tolerances of the occurrence_sample link table written by build.py
+LINK_DISTANCE = 10000  # meters
+LINK_TIME = 1  # days
+LINK_DEPTH = None  # meters, occurrence depths are mostly missing
+# size of the blocks (in tolerances) queries are sorted by before they are searched in chunks
+SEARCH_BLOCK = 50
+# margin of the bound of the SouthPolarStereo scale factor (the spherical formula is within 0.1% of WGS84)
+SCALE_MARGIN = 1.01
+MATCH_COLUMNS = ["query", "match", "distance", "time_difference", "depth_difference"]
+
+
+class PointIndex:
+    """KD-tree of points (longitude, latitude and optionally time and depth) that finds the points within a geodesic
+    distance (meters), time tolerance (days) and depth tolerance (meters) of query points. Each axis of the tree is
+    scaled by its tolerance (the SouthPolarStereo axes by the distance times the largest scale factor of the
+    projection near the points), so candidates are the points in a box of half-width 1 around the query (one search
+    of the tree) and are then filtered on the geodesic distance. Time and depth are only compared if their tolerance
+    is given; points without a position, or without a time or depth that is compared, are never matched. Matches
+    are reported by the ids of the points (their positions by default)"""
+
+    def __init__(self, lon: np.ndarray, lat: np.ndarray, times: np.ndarray = None, depths: np.ndarray = None,
+                 ids: np.ndarray = None, distance: float = LINK_DISTANCE, time_tolerance: float = None,
+                 depth_tolerance: float = None):
+        self.uses = (time_tolerance is not None, depth_tolerance is not None)
+        self.distance = distance
+        self.project = Transformer.from_crs("EPSG:4326", ccrs.SouthPolarStereo(), always_xy=True)
+        self.geod = Geod(ellps="WGS84")
+        points = self.coordinates(lon, lat, times, depths)
+        valid = np.isfinite(points).all(axis=1)
+        self.points = points[valid]
+        self.ids = (np.arange(len(points)) if ids is None else np.asarray(ids))[valid]
+        # projected distances are up to the scale factor 2 / (1 - sin(latitude)) of the northern end of a pair longer
+        # than geodesic ones, and no end of a match is more than distance north of the northernmost point
+        north = np.radians(min(self.points[:, 1].max(initial=-90) + np.degrees(distance / self.geod.a), 60))
+        spatial = distance * SCALE_MARGIN * 2 / (1 - np.sin(north))
+        self.scales = np.array([spatial, spatial] + [tolerance for tolerance in (time_tolerance, depth_tolerance)
+                                                     if tolerance is not None], dtype=float)
+        self.tree = cKDTree(self.points[:, 2:] / self.scales)
+
+    def coordinates(self, lon: np.ndarray, lat: np.ndarray, times: np.ndarray = None,
+                    depths: np.ndarray = None) -> np.ndarray:
+        """Points x features: longitude, latitude, SouthPolarStereo x and y, and the time (days) and depth that are
+        compared"""
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        columns = [lon, lat, *self.project.transform(lon, lat)]
+        for used, values, name in zip(self.uses, (times, depths), ("times", "depths")):
+            if used:
+                assert values is not None, f"{name} are needed to match within a tolerance"
+                columns.append(np.asarray(values, dtype=float))
+        return np.stack(columns, axis=1)
+
+    def within(self, lon: np.ndarray, lat: np.ndarray, times: np.ndarray = None, depths: np.ndarray = None,
+               chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+        """All matches of the query points: query (position of the query point), match (id of the point), distance
+        (geodesic, meters), time_difference (days) and depth_difference (point - query, NaN if not compared), sorted
+        by query and distance. Queries are sorted by position and searched chunk_rows at a time with a tree of the
+        chunk"""
+        return self.search(self.coordinates(lon, lat, times, depths), chunk_rows, nearest=False)
+
+    def nearest(self, lon: np.ndarray, lat: np.ndarray, times: np.ndarray = None, depths: np.ndarray = None,
+                chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+        """Nearest match of each query point (closest in distance, then in time), the columns of within. Queries
+        without a match within the tolerances are left out"""
+        return self.search(self.coordinates(lon, lat, times, depths), chunk_rows, nearest=True)
+
+    def search(self, queries: np.ndarray, chunk_rows: int, nearest: bool) -> pd.DataFrame:
+        """Matches of the queries (rows of coordinates), see within and nearest"""
+        valid = np.flatnonzero(np.isfinite(queries).all(axis=1))
+        # chunks of nearby queries visit few nodes of the tree
+        blocks = np.floor(queries[valid, 2:4] / self.scales[:2] / SEARCH_BLOCK)
+        valid = valid[np.lexsort((blocks[:, 0], blocks[:, 1]))]
+        frames = [pd.DataFrame({"query": np.empty(0, dtype=int), "match": self.ids[:0],
+                                **{name: np.empty(0) for name in MATCH_COLUMNS[2:]}})]
+        for start in range(0, len(valid), chunk_rows):
+            matches = self.match_chunk(queries, valid[start:start + chunk_rows])
+            if nearest:
+                query = matches["query"].to_numpy()
+                matches = matches[np.diff(query, prepend=-1) != 0]
+            frames.append(matches)
+        matches = pd.concat(frames, ignore_index=True)
+        order = np.lexsort((np.abs(matches["time_difference"].fillna(0)), matches["distance"], matches["query"]))
+        return matches.iloc[order].reset_index(drop=True)
+
+    def match_chunk(self, queries: np.ndarray, positions: np.ndarray) -> pd.DataFrame:
+        """Matches of the queries at positions, the columns of within sorted by query, distance and time"""
+        pairs = cKDTree(queries[positions, 2:] / self.scales).sparse_distance_matrix(self.tree, 1, p=np.inf,
+                                                                                      output_type="ndarray")
+        query, point = positions[pairs["i"]], pairs["j"]
+        distance = self.geod.inv(queries[query, 0], queries[query, 1], self.points[point, 0],
+                                 self.points[point, 1])[2]
+        inside = distance <= self.distance
+        query, point = query[inside], point[inside]
+        difference = self.points[point] - queries[query]
+        columns = {"query": query, "match": self.ids[point], "distance": distance[inside]}
+        axis = 4
+        for used, name in zip(self.uses, ("time_difference", "depth_difference")):
+            columns[name] = difference[:, axis] if used else np.full(len(query), np.nan)
+            axis += used
+        matches = pd.DataFrame(columns)
+        order = np.lexsort((np.abs(matches["time_difference"].fillna(0)), matches["distance"], matches["query"]))
+        return matches.iloc[order]
+
+
+def day_numbers(date_times: pd.Series) -> np.ndarray:
+    """Days since 1970 of date_time strings (NaN if missing or invalid)"""
+    times = pd.to_datetime(date_times, errors="coerce", format="mixed")
+    return ((times - pd.Timestamp(0)) / pd.Timedelta(days=1)).to_numpy(dtype=float, na_value=np.nan)
+
+
+def table_points(con: sqlite3.Connection, table: str) -> pd.DataFrame:
+    """id, longitude, latitude, time (days, see day_numbers) and depth of the rows of sample or occurrence"""
+    points = pd.read_sql(f"SELECT id, longitude, latitude, date_time, depth FROM {table}", con)
+    points["time"] = day_numbers(points.pop("date_time"))
+    return points
+
+
+def sample_index(con: sqlite3.Connection, distance: float = LINK_DISTANCE, time_tolerance: float = LINK_TIME,
+                 depth_tolerance: float = LINK_DEPTH) -> PointIndex:
+    """Index of the samples, matches are sample ids"""
+    samples = table_points(con, "sample")
+    return PointIndex(samples["longitude"], samples["latitude"], samples["time"], samples["depth"], samples["id"],
+                      distance, time_tolerance, depth_tolerance)
+
+
+def grid_cells(layer_dir: str, lon: np.ndarray, lat: np.ndarray, name: str = None) -> np.ndarray:
+    """Flat index (row * columns + column, rows from the top) of the cell of a layer's grid (the first layer of
+    layer_dir by default) containing each point, -1 outside the grid"""
+    header = load_layer(layer_dir, name or layer_names(layer_dir)[0])[1]
+    x, y = Transformer.from_crs("EPSG:4326", GRID_CRS, always_xy=True).transform(np.asarray(lon, dtype=float),
+                                                                                 np.asarray(lat, dtype=float))
+    row, col = cell_indices(header, x, y)
+    return np.where(row >= 0, row * header["ncols"] + col, -1)
+
+
+def link_occurrence_samples(con: sqlite3.Connection, distance: float = LINK_DISTANCE, time_tolerance: float = LINK_TIME,
+                            depth_tolerance: float = LINK_DEPTH, chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+    """Nearest sample of every occurrence within the tolerances: the columns of the occurrence_sample table
+    (occurrence_id, sample_id, distance, time_difference, depth_difference)"""
+    index = sample_index(con, distance, time_tolerance, depth_tolerance)
+    occurrences = table_points(con, "occurrence")
+    matches = index.nearest(occurrences["longitude"], occurrences["latitude"], occurrences["time"],
+                            occurrences["depth"], chunk_rows)
+    matches["query"] = occurrences["id"].to_numpy()[matches["query"].to_numpy(dtype=int)]
+    return matches.rename(columns={"query": "occurrence_id", "match": "sample_id"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match occurrences to the nearest samples or BSOSE grid cells")
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH, help="Database to match (not modified)")
+    parser.add_argument("--out", required=True, help="CSV file of the matches")
+    parser.add_argument("--grid", metavar="LAYER_DIR", help="Match to the cells of the layers in this directory "
+                                                            "containing the occurrences instead of the samples")
+    parser.add_argument("--distance", type=float, default=LINK_DISTANCE, help="Largest distance (m) to a sample")
+    parser.add_argument("--time", type=float, default=LINK_TIME, help="Largest time difference (days) to a sample")
+    parser.add_argument("--depth", type=float, default=LINK_DEPTH, help="Largest depth difference (m) to a sample")
+    parser.add_argument("--all", action="store_true", help="Every sample within the tolerances, not only the nearest")
+    args = parser.parse_args()
+
+    con = connect_readonly(args.db)
+    occurrences = table_points(con, "occurrence")
+    if args.grid:
+        cells = grid_cells(args.grid, occurrences["longitude"], occurrences["latitude"])
+        matches = pd.DataFrame({"occurrence_id": occurrences["id"], "cell": cells})[cells >= 0]
+    else:
+        index = sample_index(con, args.distance, args.time, args.depth)
+        match = index.within if args.all else index.nearest
+        matches = match(occurrences["longitude"], occurrences["latitude"], occurrences["time"], occurrences["depth"])
+        matches["query"] = occurrences["id"].to_numpy()[matches["query"].to_numpy(dtype=int)]
+        matches = matches.rename(columns={"query": "occurrence_id", "match": "sample_id"})
+    con.close()
+    matches.to_csv(args.out, index=False)
+    print(f"{len(matches)} matches written to {args.out}")
@@ -0,0 +1,218 @@
+"""Evaluates MaxEnt predictions like the Java program reports them (AUC, omission curve, the standard thresholds of
+maxentResults.csv) from raw predictions at presence and background cells. Statistics are computed on sorted
+predictions with binary searches, so a curve or table costs one sort of the background. Cross-validates the models
+of maxent_fit.py with random or spatially blocked folds, one fold per task of a process pool"""
+
+import os
+import argparse
+import contextlib
+import functools
+import numpy as np
+import pandas as pd
+from scipy.stats import binom
+from concurrent.futures import ProcessPoolExecutor
+from model_lambdas import MaxentModel, META_KEYS, transform_output
+from rasters import layer_names
+from maxent_fit import (PRESENCE_DIR, PRESENCE_FILE, LAYERS_DIR, BACKGROUND_POINTS, layer_stack, training_cells,
+                        cell_values, fit_model)
+
+FIXED_CUMULATIVE = (1, 5, 10)
+TEN_PERCENTILE = 0.1
+# weights of the omission rate, cumulative threshold and predicted area MaxEnt balances
+BALANCE_WEIGHTS = (6, 0.04, 1.6)
+FOLD_METHODS = ("random", "block")
+FOLDS = 5
+BLOCK_CELLS = 30  # side of the spatial blocks in grid cells (about 560 km on the BSOSE grid)
+
+
+class Background:
+    """Raw predictions at the background cells (they sum to 1), sorted with their cumulative values, so thresholds,
+    areas and cumulative values of any predictions are binary searches"""
+
+    def __init__(self, raw: np.ndarray, entropy: float):
+        self.raw = np.sort(np.asarray(raw, dtype=float))
+        self.entropy = entropy
+        # MaxEnt's cumulative value of a raw value: 100 x the sum of the background predictions <= it
+        self.cumulative_values = 100 * np.cumsum(self.raw) / self.raw.sum()
+
+    def cumulative(self, raw: np.ndarray) -> np.ndarray:
+        """Cumulative values of raw predictions"""
+        index = np.searchsorted(self.raw, raw, side="right")
+        return np.where(index > 0, self.cumulative_values[np.maximum(index - 1, 0)], 0.0)
+
+    def area(self, raw: np.ndarray) -> np.ndarray:
+        """Fraction of the background cells predicted at least raw (the predicted area of the threshold raw)"""
+        return 1 - np.searchsorted(self.raw, raw, side="left") / len(self.raw)
+
+    def threshold(self, cumulative: np.ndarray) -> np.ndarray:
+        """Smallest background raw prediction whose cumulative value is at least cumulative"""
+        index = np.searchsorted(self.cumulative_values, cumulative, side="left")
+        return self.raw[np.minimum(index, len(self.raw) - 1)]
+
+    def cloglog(self, raw: np.ndarray) -> np.ndarray:
+        """Cloglog output of raw predictions"""
+        return transform_output(np.log(raw), self.entropy, "cloglog")
+
+
+def omission(presence: np.ndarray, raw: np.ndarray) -> np.ndarray:
+    """Fraction of the presence predictions below the thresholds raw"""
+    return np.searchsorted(np.sort(presence), raw, side="left") / max(len(presence), 1)
+
+
+def auc(presence: np.ndarray, background: np.ndarray) -> float:
+    """Area under the ROC curve of presence against background predictions: the probability that a presence is
+    predicted above a background cell, ties count half (Mann-Whitney U over the sorted background)"""
+    background = np.sort(background)
+    below = np.searchsorted(background, presence, side="left")
+    ties = np.searchsorted(background, presence, side="right") - below
+    return float(np.mean(below + ties / 2) / len(background))
+
+
+def roc_curve(presence: np.ndarray, background: np.ndarray) -> pd.DataFrame:
+    """Sensitivity and fractional predicted area (1 - specificity) of every distinct prediction as a threshold"""
+    thresholds = np.unique(np.concatenate([presence, background]))[::-1]
+    ranked = Background(background, 0.0)
+    return pd.DataFrame({"threshold": thresholds, "sensitivity": 1 - omission(presence, thresholds),
+                         "fractional_area": ranked.area(thresholds)})
+
+
+def omission_curve(background: Background, train: np.ndarray, test: np.ndarray = None) -> pd.DataFrame:
+    """MaxEnt's <class>_omission.csv: cumulative value, cloglog value, fractional area and training and test
+    omission of every distinct background prediction as a threshold"""
+    thresholds = np.unique(background.raw)
+    return pd.DataFrame({"Raw value": thresholds, "Corresponding cumulative value": background.cumulative(thresholds),
+                         "Corresponding Cloglog value": background.cloglog(thresholds),
+                         "Fractional area": background.area(thresholds),
+                         "Training omission": omission(train, thresholds),
+                         "Test omission": omission(test, thresholds) if test is not None else np.nan})
+
+
+def threshold_table(background: Background, train: np.ndarray, test: np.ndarray = None) -> pd.DataFrame:
+    """The thresholds of maxentResults.csv (rows) with their cumulative and cloglog value, predicted area, training
+    and test omission and the binomial probability of the test omission given the area"""
+    train = np.sort(train)
+    candidates = np.unique(np.concatenate([train, background.raw]))
+    train_omission, area = omission(train, candidates), background.area(candidates)
+    thresholds = {f"Fixed cumulative value {value}": background.threshold(value) for value in FIXED_CUMULATIVE}
+    thresholds["Minimum training presence"] = train[0]
+    thresholds["10 percentile training presence"] = train[int(TEN_PERCENTILE * len(train))]
+    thresholds["Equal training sensitivity and specificity"] = candidates[np.argmin(np.abs(train_omission - area))]
+    thresholds["Maximum training sensitivity plus specificity"] = candidates[np.argmin(train_omission + area)]
+    if test is not None and len(test) > 0:
+        test_omission = omission(test, candidates)
+        thresholds["Equal test sensitivity and specificity"] = candidates[np.argmin(np.abs(test_omission - area))]
+        thresholds["Maximum test sensitivity plus specificity"] = candidates[np.argmin(test_omission + area)]
+    omission_weight, cumulative_weight, area_weight = BALANCE_WEIGHTS
+    balance = (omission_weight * train_omission + cumulative_weight * background.cumulative(candidates) +
+               area_weight * area)
+    thresholds["Balance training omission, predicted area and threshold value"] = candidates[np.argmin(balance)]
+    # the area where a uniform distribution has the entropy of the model
+    equal_area = np.exp(background.entropy) / len(background.raw)
+    thresholds["Equate entropy of thresholded and original distributions"] = \
+        candidates[np.argmin(np.abs(area - equal_area))]
+    raw = np.array(list(thresholds.values()))
+    table = pd.DataFrame({"cumulative threshold": background.cumulative(raw), "Cloglog threshold":
+                          background.cloglog(raw), "area": background.area(raw),
+                          "training omission": omission(train, raw)}, index=list(thresholds))
+    table.loc[[f"Fixed cumulative value {value}" for value in FIXED_CUMULATIVE], "cumulative threshold"] = \
+        FIXED_CUMULATIVE
+    if test is not None and len(test) > 0:
+        table["test omission"] = omission(test, raw)
+        # probability of predicting at least as many test presences with random cells of the area
+        hits = np.round((1 - table["test omission"]) * len(test))
+        table["binomial probability"] = binom.sf(hits - 1, len(test), table["area"])
+    return table
+
+
+def evaluate(background: Background, train: np.ndarray, test: np.ndarray = None) -> dict:
+    """Training and test AUC and the cumulative threshold, area and omission of each threshold of threshold_table,
+    flattened like the columns of maxentResults.csv"""
+    result = {"#Training samples": len(train), "Training AUC": auc(train, background.raw)}
+    if test is not None:
+        result |= {"#Test samples": len(test), "Test AUC": auc(test, background.raw) if len(test) > 0 else np.nan}
+    for rule, row in threshold_table(background, train, test).iterrows():
+        result |= {f"{rule} {column}": value for column, value in row.items()}
+    return result
+
+
+def random_folds(count: int, folds: int, rng: np.random.Generator) -> np.ndarray:
+    """Fold of each of count presences, folds of (almost) equal size"""
+    return rng.permutation(count) % folds
+
+
+def block_folds(cells: np.ndarray, ncols: int, folds: int, rng: np.random.Generator,
+                block_cells: int = BLOCK_CELLS) -> np.ndarray:
+    """Fold of each presence cell (flat grid index): the grid is split into square blocks of block_cells cells and
+    every block, with all its presences, goes to one fold. Blocks are dealt to folds in random order"""
+    blocks = (cells // ncols // block_cells) * (ncols // block_cells + 1) + cells % ncols // block_cells
+    unique, index = np.unique(blocks, return_inverse=True)
+    return rng.permutation(len(unique))[index] % folds
+
+
+def cross_validate_fold(task: tuple[str, str, int], folds: int = FOLDS, method: str = "random",
+                        presence_dir: str = PRESENCE_DIR, layers_dir: str = LAYERS_DIR,
+                        background: int = BACKGROUND_POINTS, seed: int = 0, **fit_args) -> dict:
+    """Fits the model of a (season, class, fold) task on the presences of the other folds and evaluates it on the
+    presences of the fold (evaluate). The background is the same random sample in every fold, with the training
+    presences added and the test presences removed"""
+    season, name, fold = task
+    assert method in FOLD_METHODS, f"method is one of {FOLD_METHODS}, not {method}"
+    points = pd.read_csv(os.path.join(presence_dir, PRESENCE_FILE.format(season=season)))
+    points = points[points["class"] == name]
+    layer_dir = os.path.join(layers_dir, season)
+    names = layer_names(layer_dir)
+    grids, header = layer_stack(layer_dir, names)
+    rng = np.random.default_rng(seed)
+    presence, background_cells = training_cells(grids, header, points["longitude"].to_numpy(),
+                                                points["latitude"].to_numpy(), background, rng)
+    assignment = random_folds(len(presence), folds, rng) if method == "random" else \
+        block_folds(presence, header["ncols"], folds, rng)
+    train, test = presence[assignment != fold], presence[assignment == fold]
+    assert len(train) > 0, f"Every {name} {season} presence is in fold {fold}"
+    # the training presences are part of the background, the test presences never are
+    background_cells = np.setdiff1d(np.union1d(background_cells, train), test)
+    background_values = cell_values(grids, background_cells)
+    model = MaxentModel.from_lambdas(fit_model(names, cell_values(grids, train), background_values, **fit_args))
+    raw = {key: model.project(dict(zip(names, cell_values(grids, cells).T)), "raw")
+           for key, cells in (("train", train), ("test", test))}
+    ranked = Background(model.project(dict(zip(names, background_values.T)), "raw"), model.meta[META_KEYS.index("entropy")])
+    return {"season": season, "class": name, "fold": fold, **evaluate(ranked, raw["train"], raw["test"])}
+
+
+def cross_validate(seasons: list[str], folds: int = FOLDS, method: str = "random", presence_dir: str = PRESENCE_DIR,
+                   layers_dir: str = LAYERS_DIR, background: int = BACKGROUND_POINTS, seed: int = 0, jobs: int = 1,
+                   **fit_args) -> pd.DataFrame:
+    """Cross-validation of the models of every class and season (see cross_validate_fold), one row per fold.
+    Folds are fitted and evaluated by a pool of jobs processes"""
+    tasks = []
+    for season in seasons:
+        points = pd.read_csv(os.path.join(presence_dir, PRESENCE_FILE.format(season=season)), usecols=["class"])
+        tasks += [(season, name, fold) for name in sorted(points["class"].unique()) for fold in range(folds)]
+    validate = functools.partial(cross_validate_fold, folds=folds, method=method, presence_dir=presence_dir,
+                                 layers_dir=layers_dir, background=background, seed=seed, **fit_args)
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else contextlib.nullcontext() as pool:
+        return pd.DataFrame(list(pool.map(validate, tasks) if pool is not None else map(validate, tasks)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validate the MaxEnt models of every class and season")
+    parser.add_argument("out", help="CSV file of the results (one row per class, season and fold)")
+    parser.add_argument("--presence", default=PRESENCE_DIR, help=f"Directory of the {PRESENCE_FILE} presence points")
+    parser.add_argument("--layers", default=LAYERS_DIR, help="Directory of <season>/<variable>.asc layers")
+    parser.add_argument("--seasons", nargs="*", help="Seasons to validate (all seasons with layers by default)")
+    parser.add_argument("--folds", type=int, default=FOLDS, help="Number of folds")
+    parser.add_argument("--method", choices=FOLD_METHODS, default="random",
+                        help="Random folds or spatial blocks of presences")
+    parser.add_argument("--beta_multiplier", type=float, default=1.0, help="Multiplier of the regularization")
+    parser.add_argument("--background", type=int, default=BACKGROUND_POINTS, help="Number of background cells")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the background sample and the folds")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of folds validated in parallel")
+    args = parser.parse_args()
+
+    seasons = args.seasons or sorted(name for name in os.listdir(args.layers)
+                                     if os.path.isdir(os.path.join(args.layers, name)))
+    results = cross_validate(seasons, args.folds, args.method, args.presence, args.layers, args.background, args.seed,
+                             args.jobs, beta_multiplier=args.beta_multiplier)
+    results.to_csv(args.out, index=False)
+    summary = results.groupby(["season", "class"])[["Training AUC", "Test AUC"]].agg(["mean", "std"])
+    print(summary.round(4).to_string())
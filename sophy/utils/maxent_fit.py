@@ -0,0 +1,289 @@
+"""Fits the MaxEnt model of every phytoplankton class and season without the maxent.jar round-trip. Presence points
+and background cells are sampled from the BSOSE layers, MaxEnt's feature classes are generated from them and the
+L1-regularized MaxEnt objective is minimized in NumPy. Classes are fitted in parallel and every model is written as
+a <season>/<class>.lambdas file that model_lambdas.py and maxent_maps.py read like the Java output"""
+
+import os
+import argparse
+import contextlib
+import functools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from rasters import layer_names, load_layer, grid_header, cell_indices
+
+PRESENCE_DIR = "../../data/maxent_src/in/sophy_presence_processed/"
+PRESENCE_FILE = "sophy_mercator_{season}.csv"
+LAYERS_DIR = "../../data/maxent_src/in/bsose_processed/asc/"
+MODELS_DIR = "../../data/maxent_src/out/python/"
+BACKGROUND_POINTS = 10000
+HINGE_KNOTS = 50
+FEATURE_CLASSES = ("linear", "quadratic", "product", "threshold", "hinge")
+# MaxEnt's automatic features: a feature class is used from this number of presence cells
+AUTO_FEATURES = {"linear": 1, "quadratic": 10, "hinge": 15, "product": 80, "threshold": 80}
+# regularization multipliers of the feature classes, interpolated on the number of presence cells (MaxEnt defaults).
+# Linear and quadratic features use the product table when product features are used
+REGULARIZATION = {"linear": ((0, 10, 30, 100), (1, 1, 0.2, 0.05)),
+                  "product": ((0, 10, 17, 30, 100), (2.6, 1.6, 0.9, 0.55, 0.05)),
+                  "threshold": ((0, 100), (2, 1)), "hinge": ((0, 1), (0.5, 0.5))}
+TOLERANCE = 1e-8
+MAX_ITERATIONS = 100
+
+
+def layer_stack(layer_dir: str, names: list[str]) -> tuple[list[np.ndarray], dict]:
+    """Flattened memory-mapped grids of the layers and their common grid header"""
+    grids, header = [], None
+    for name in names:
+        grid, layer_header = load_layer(layer_dir, name)
+        assert header is None or grid_header(layer_header) == header, f"{name} is not on the grid of the other layers"
+        grids.append(grid.reshape(-1))
+        header = grid_header(layer_header)
+    return grids, header
+
+
+def training_cells(grids: list[np.ndarray], header: dict, x: np.ndarray, y: np.ndarray, background: int,
+                   rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Grid cells (flat indices) of the presence points and a random sample of background cells. Points in the same
+    cell count once and cells where a layer has no data are left out"""
+    row, col = cell_indices(header, x, y)
+    presence = np.unique((row * header["ncols"] + col)[row >= 0])
+    valid = np.ones(header["nrows"] * header["ncols"], dtype=bool)
+    for grid in grids:
+        valid &= ~np.isnan(grid)
+    cells = np.flatnonzero(valid)
+    return presence[valid[presence]], np.sort(rng.choice(cells, min(background, len(cells)), replace=False))
+
+
+def cell_values(grids: list[np.ndarray], cells: np.ndarray) -> np.ndarray:
+    """Layer values (cells x layers) of grid cells"""
+    return np.stack([grid[cells] for grid in grids], axis=1).astype(float)
+
+
+def make_features(names: list[str], background: np.ndarray, feature_classes: tuple[str]) -> pd.DataFrame:
+    """Candidate features over the background (cells x variables), in the columns of parse_lambdas() (without lambda)
+    and with the index of their variable(s). Features are scaled to [0, 1] on their background range"""
+    rows = []
+    var_min, var_max = background.min(axis=0), background.max(axis=0)
+    for i, name in enumerate(names):
+        rows.append((name, "linear", var_min[i], var_max[i], np.nan, i, i))
+    if "quadratic" in feature_classes:
+        squares = background ** 2
+        rows += [(name, "quadratic", squares[:, i].min(), squares[:, i].max(), np.nan, i, i)
+                 for i, name in enumerate(names)]
+    if "product" in feature_classes:
+        for i in range(len(names)):
+            for j in range(i + 1, len(names)):
+                products = background[:, i] * background[:, j]
+                rows.append((f"{names[i]}*{names[j]}", "product", products.min(), products.max(), np.nan, i, j))
+    for i, name in enumerate(names):
+        knots = np.linspace(var_min[i], var_max[i], HINGE_KNOTS)
+        if "threshold" in feature_classes:
+            rows += [(name, "threshold", 0.0, 1.0, knot, i, i) for knot in knots[1:-1]]
+        if "hinge" in feature_classes:
+            rows += [(name, "forward_hinge", knot, var_max[i], np.nan, i, i) for knot in knots[:-1]]
+            rows += [(name, "reverse_hinge", var_min[i], knot, np.nan, i, i) for knot in knots[1:]]
+    features = pd.DataFrame(rows, columns=["feature", "type", "min", "max", "value", "first", "second"])
+    # constant features (ex: a layer with one value) can't be fitted
+    return features[features["max"] > features["min"]].reset_index(drop=True)
+
+
+def feature_values(features: pd.DataFrame, env: np.ndarray) -> np.ndarray:
+    """Scaled features (cells x features) of the cells of env (cells x variables)"""
+    first, second = env[:, features["first"]], env[:, features["second"]]
+    fmin, fmax = features["min"].to_numpy(), features["max"].to_numpy()
+    typ = features["type"].to_numpy()
+    raw = first.copy()
+    raw[:, typ == "quadratic"] **= 2
+    raw[:, typ == "product"] *= second[:, typ == "product"]
+    threshold = typ == "threshold"
+    raw[:, threshold] = first[:, threshold] > features["value"].to_numpy()[threshold]
+    forward, reverse = typ == "forward_hinge", typ == "reverse_hinge"
+    raw[:, forward] = np.maximum(first[:, forward], fmin[forward])
+    raw[:, reverse] = fmin[reverse] + np.maximum(fmax[reverse] - first[:, reverse], 0)
+    return (raw - fmin) / (fmax - fmin)
+
+
+def regularization(features: pd.DataFrame, presence: np.ndarray, beta_multiplier: float) -> np.ndarray:
+    """L1 penalty of each feature: the regularization multiplier of its class (for the number of presence cells)
+    times the standard deviation of the feature over the presence cells (scaled features), over sqrt(cells)"""
+    samples = len(presence)
+    deviation = presence.std(axis=0, ddof=1) if samples > 1 else np.zeros(presence.shape[1])
+    classes = features["type"].replace({"quadratic": "linear", "forward_hinge": "hinge", "reverse_hinge": "hinge"})
+    if (classes == "product").any():
+        classes = classes.replace({"linear": "product"})
+    multiplier = classes.map({name: np.interp(samples, *table) for name, table in REGULARIZATION.items()})
+    penalty = multiplier.to_numpy() * deviation / np.sqrt(samples)
+    hinge = (classes == "hinge").to_numpy()
+    penalty[hinge] = np.maximum(penalty[hinge], 0.5 / samples)
+    # thresholds that all or none of the presence cells pass
+    threshold = (classes == "threshold").to_numpy()
+    penalty[threshold & (deviation == 0)] = 1
+    return beta_multiplier * np.maximum(penalty, 0.001)
+
+
+def fit_lambdas(background: np.ndarray, target: np.ndarray, penalty: np.ndarray, tolerance: float = TOLERANCE,
+                max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    """Lambdas minimizing log(sum(exp(background @ lambdas))) - target @ lambdas + penalty @ abs(lambdas), the
+    MaxEnt loss of scaled features over the background cells (cells x features) with the mean presence features
+    target. Proximal Newton: each step minimizes the L1-penalized quadratic model of the loss (quadratic_step) and
+    is shortened until the loss decreases enough, until the loss changes by less than tolerance"""
+    def loss(lambdas: np.ndarray) -> float:
+        predictor = background @ lambdas
+        top = predictor.max()
+        return top + np.log(np.exp(predictor - top).sum()) - target @ lambdas + penalty @ np.abs(lambdas)
+
+    lambdas = np.zeros(background.shape[1])
+    current = loss(lambdas)
+    for _ in range(max_iterations):
+        # the background distribution of the lambdas, the gradient and hessian of the loss
+        predictor = background @ lambdas
+        weights = np.exp(predictor - predictor.max())
+        weights /= weights.sum()
+        mean = weights @ background
+        scaled = background * np.sqrt(weights)[:, None]
+        hessian = scaled.T @ scaled - np.outer(mean, mean)
+        direction = quadratic_step(hessian, mean - target, lambdas, penalty) - lambdas
+        decrease = (mean - target) @ direction + penalty @ (np.abs(lambdas + direction) - np.abs(lambdas))
+        step = 1.0
+        while loss(lambdas + step * direction) > current + 0.01 * step * decrease and step > 1e-10:
+            step /= 2
+        lambdas = lambdas + step * direction
+        previous, current = current, loss(lambdas)
+        if previous - current < tolerance:
+            break
+    return lambdas
+
+
+def quadratic_step(hessian: np.ndarray, gradient: np.ndarray, lambdas: np.ndarray, penalty: np.ndarray) -> np.ndarray:
+    """Minimizer w of gradient @ (w - lambdas) + (w - lambdas) @ hessian @ (w - lambdas) / 2 + penalty @ abs(w), by
+    feature-sign search: the quadratic is solved on the features with a sign, stopping where a feature changes sign
+    (it leaves), then the zero feature that most violates optimality gets a sign, until none does"""
+    def objective(w: np.ndarray) -> float:
+        change = w - lambdas
+        return gradient @ change + change @ hessian @ change / 2 + penalty @ np.abs(w)
+
+    w, signs = lambdas.copy(), np.sign(lambdas)
+    center = hessian @ lambdas - gradient
+    for _ in range(10 * len(w) + 10):
+        support = np.flatnonzero(signs)
+        if len(support) > 0:
+            solution = np.zeros(len(w))
+            solution[support] = np.linalg.lstsq(hessian[np.ix_(support, support)],
+                                                center[support] - penalty[support] * signs[support], rcond=None)[0]
+            flipped = support[np.sign(solution[support]) != signs[support]]
+            if len(flipped) > 0:
+                # best of the solution and of the points on the way to it where a feature crosses zero
+                points = [solution]
+                for i in flipped:
+                    point = w + w[i] / (w[i] - solution[i]) * (solution - w)
+                    point[i] = 0
+                    points.append(point)
+                w = min(points, key=objective)
+                signs = np.sign(w)
+                continue
+            w = solution
+        gradient_w = gradient + hessian @ (w - lambdas)
+        violation = np.where(signs == 0, np.abs(gradient_w) - penalty, -np.inf)
+        i = np.argmax(violation)
+        if violation[i] <= 1e-12:
+            break
+        signs[i] = -np.sign(gradient_w[i])
+    return w
+
+
+def fit_model(names: list[str], presence: np.ndarray, background: np.ndarray, feature_classes: tuple[str] = None,
+              beta_multiplier: float = 1.0) -> tuple[pd.DataFrame, dict]:
+    """Features and metadata of the MaxEnt model of the presence cells over the background cells (cells x variables),
+    like parse_lambdas() output (MaxentModel.from_lambdas compiles it). Feature classes are chosen by the number of
+    presence cells by default"""
+    if feature_classes is None:
+        feature_classes = tuple(name for name, samples in AUTO_FEATURES.items() if len(presence) >= samples)
+    features = make_features(names, background, feature_classes)
+    background_features = feature_values(features, background)
+    presence_features = feature_values(features, presence)
+    features["lambda"] = fit_lambdas(background_features, presence_features.mean(axis=0),
+                                     regularization(features, presence_features, beta_multiplier))
+    # raw output is exp(predictor - linearPredictorNormalizer) / densityNormalizer and sums to 1 over the background
+    predictor = background_features @ features["lambda"].to_numpy()
+    normalizer = predictor.max()
+    weights = np.exp(predictor - normalizer)
+    raw = weights / weights.sum()
+    meta = {"linearPredictorNormalizer": float(normalizer), "densityNormalizer": float(weights.sum()),
+            "numBackgroundPoints": len(background), "entropy": float(-np.sum(raw * np.log(raw)))}
+    return features, meta
+
+
+def write_lambdas(path: str, features: pd.DataFrame, meta: dict):
+    """Writes a model in the .lambdas format of MaxEnt: every linear, quadratic and product feature, the other
+    features with a nonzero lambda, then the metadata"""
+    kept = features[features["type"].isin(["linear", "quadratic", "product"]) | (features["lambda"] != 0)]
+    labels = {"linear": "{}", "quadratic": "{}^2", "product": "{}", "threshold": "({1!r}<{0})",
+              "forward_hinge": "'{}", "reverse_hinge": "`{}"}
+    with open(path, "w") as file:
+        for feature, typ, _lambda, fmin, fmax, value in kept[["feature", "type", "lambda", "min", "max",
+                                                              "value"]].itertuples(index=False):
+            label = labels[typ].format(feature, float(value))
+            file.write(f"{label}, {float(_lambda)!r}, {float(fmin)!r}, {float(fmax)!r}\n")
+        for key, value in meta.items():
+            file.write(f"{key}, {value!r}\n")
+
+
+def fit_class(task: tuple[str, str], presence_dir: str = PRESENCE_DIR, layers_dir: str = LAYERS_DIR,
+              out_dir: str = MODELS_DIR, feature_classes: tuple[str] = None, beta_multiplier: float = 1.0,
+              background: int = BACKGROUND_POINTS, seed: int = 0) -> str:
+    """Fits the model of a (season, class) task and writes it to out_dir/<season>/<class>.lambdas. Returns its path"""
+    season, name = task
+    points = pd.read_csv(os.path.join(presence_dir, PRESENCE_FILE.format(season=season)))
+    points = points[points["class"] == name]
+    layer_dir = os.path.join(layers_dir, season)
+    names = layer_names(layer_dir)
+    grids, header = layer_stack(layer_dir, names)
+    presence, background_cells = training_cells(grids, header, points["longitude"].to_numpy(),
+                                                points["latitude"].to_numpy(), background,
+                                                np.random.default_rng(seed))
+    assert len(presence) > 0, f"No {name} presence in a cell with data in every {season} layer"
+    # the presence cells are part of the background
+    features, meta = fit_model(names, cell_values(grids, presence),
+                               cell_values(grids, np.union1d(background_cells, presence)), feature_classes,
+                               beta_multiplier)
+    os.makedirs(os.path.join(out_dir, season), exist_ok=True)
+    path = os.path.join(out_dir, season, f"{name}.lambdas")
+    write_lambdas(path, features, meta)
+    return path
+
+
+def fit_models(seasons: list[str], presence_dir: str = PRESENCE_DIR, layers_dir: str = LAYERS_DIR,
+               out_dir: str = MODELS_DIR, feature_classes: tuple[str] = None, beta_multiplier: float = 1.0,
+               background: int = BACKGROUND_POINTS, seed: int = 0, jobs: int = 1) -> list[str]:
+    """Models of every class of every season (see fit_class), fitted by a pool of jobs processes"""
+    tasks = []
+    for season in seasons:
+        points = pd.read_csv(os.path.join(presence_dir, PRESENCE_FILE.format(season=season)), usecols=["class"])
+        tasks += [(season, name) for name in sorted(points["class"].unique())]
+    fit = functools.partial(fit_class, presence_dir=presence_dir, layers_dir=layers_dir, out_dir=out_dir,
+                            feature_classes=feature_classes, beta_multiplier=beta_multiplier, background=background,
+                            seed=seed)
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else contextlib.nullcontext() as pool:
+        return list(pool.map(fit, tasks) if pool is not None else map(fit, tasks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the MaxEnt models of every class and season")
+    parser.add_argument("--presence", default=PRESENCE_DIR, help=f"Directory of the {PRESENCE_FILE} presence points")
+    parser.add_argument("--layers", default=LAYERS_DIR, help="Directory of <season>/<variable>.asc layers")
+    parser.add_argument("--out", default=MODELS_DIR, help="Directory of the <season>/<class>.lambdas models")
+    parser.add_argument("--seasons", nargs="*", help="Seasons to fit (all seasons with layers by default)")
+    parser.add_argument("--features", nargs="*", choices=FEATURE_CLASSES,
+                        help="Feature classes (chosen by the number of presence cells by default)")
+    parser.add_argument("--beta_multiplier", type=float, default=1.0, help="Multiplier of the regularization")
+    parser.add_argument("--background", type=int, default=BACKGROUND_POINTS, help="Number of background cells")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the background sample")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of models fitted in parallel")
+    args = parser.parse_args()
+
+    seasons = args.seasons or sorted(name for name in os.listdir(args.layers)
+                                     if os.path.isdir(os.path.join(args.layers, name)))
+    features = tuple(args.features) if args.features else None
+    for path in fit_models(seasons, args.presence, args.layers, args.out, features, args.beta_multiplier,
+                           args.background, args.seed, args.jobs):
+        print(f"Model written to {path}")
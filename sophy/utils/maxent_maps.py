@@ -0,0 +1,80 @@
+"""Projects the MaxEnt model of every phytoplankton class and season onto the full BSOSE grid of its season.
+The classes of a season are evaluated together on one pass over the environmental layers, seasons run in parallel
+and every season's maps are written to a memory-mapped array <season>.npy (classes x rows x columns)"""
+
+import os
+import glob
+import json
+import argparse
+import contextlib
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from model_lambdas import ModelBatch, MaxentModel, load_model, OUTPUTS
+from rasters import load_layer, grid_header
+
+MODELS_DIR = "../../data/maxent_src/out/java/"
+LAYERS_DIR = "../../data/maxent_src/in/bsose_processed/asc/"
+MAPS_DIR = "../../data/maxent_src/out/maps/"
+
+
+def season_models(models_dir: str, season: str) -> dict[str, MaxentModel]:
+    """Compiled models of models_dir/<season>/<class>.lambdas, keyed by class"""
+    paths = sorted(glob.glob(os.path.join(models_dir, season, "*.lambdas")))
+    return {os.path.basename(path)[:-len(".lambdas")]: load_model(path) for path in paths}
+
+
+def project_season(season: str, models_dir: str = MODELS_DIR, layers_dir: str = LAYERS_DIR, out_dir: str = MAPS_DIR,
+                   output: str = "cloglog", clamp: bool = True) -> str:
+    """Writes the maps of every class of a season to out_dir/<season>.npy (float32, NaN where a layer has no data)
+    and the classes and grid of the maps to out_dir/<season>.json. Returns the path of the maps"""
+    models = season_models(models_dir, season)
+    assert len(models) > 0, f"No .lambdas files in {os.path.join(models_dir, season)}"
+    batch = ModelBatch(list(models.values()))
+    layers, header = {}, None
+    for name in batch.variables:
+        layers[name], layer_header = load_layer(os.path.join(layers_dir, season), name)
+        assert header is None or grid_header(layer_header) == header, \
+            f"{name} is not on the grid of the other {season} layers"
+        header = grid_header(layer_header)
+    maps_path = os.path.join(out_dir, f"{season}.npy")
+    maps = np.lib.format.open_memmap(maps_path, mode="w+", dtype=np.float32,
+                                     shape=(len(models), header["nrows"], header["ncols"]))
+    batch.project(layers, output, clamp, out=maps)
+    maps.flush()
+    json.dump({"classes": list(models), "output": output, "clamp": clamp, **header},
+              open(os.path.join(out_dir, f"{season}.json"), "w"))
+    return maps_path
+
+
+def project_maps(seasons: list[str], models_dir: str = MODELS_DIR, layers_dir: str = LAYERS_DIR,
+                 out_dir: str = MAPS_DIR, output: str = "cloglog", clamp: bool = True, jobs: int = 1) -> list[str]:
+    """Maps of every season (see project_season), seasons are projected by a pool of jobs processes"""
+    os.makedirs(out_dir, exist_ok=True)
+    project = functools.partial(project_season, models_dir=models_dir, layers_dir=layers_dir, out_dir=out_dir,
+                                output=output, clamp=clamp)
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else contextlib.nullcontext() as pool:
+        return list(pool.map(project, seasons) if pool is not None else map(project, seasons))
+
+
+def load_maps(season: str, out_dir: str = MAPS_DIR) -> tuple[np.ndarray, dict]:
+    """Memory-mapped maps (classes x rows x columns) and header (classes, grid) of a season"""
+    return (np.load(os.path.join(out_dir, f"{season}.npy"), mmap_mode="r"),
+            json.load(open(os.path.join(out_dir, f"{season}.json"), "r")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Project the MaxEnt models of every class and season")
+    parser.add_argument("--models", default=MODELS_DIR, help="Directory of <season>/<class>.lambdas models")
+    parser.add_argument("--layers", default=LAYERS_DIR, help="Directory of <season>/<variable>.asc layers")
+    parser.add_argument("--out", default=MAPS_DIR, help="Directory of the <season>.npy maps")
+    parser.add_argument("--seasons", nargs="*", help="Seasons to project (all seasons with models by default)")
+    parser.add_argument("--output", choices=OUTPUTS, default="cloglog", help="MaxEnt output format")
+    parser.add_argument("--no_clamp", action="store_true", help="Don't clamp variables to their training range")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of seasons projected in parallel")
+    args = parser.parse_args()
+
+    seasons = args.seasons or sorted(name for name in os.listdir(args.models)
+                                     if os.path.isdir(os.path.join(args.models, name)))
+    for path in project_maps(seasons, args.models, args.layers, args.out, args.output, not args.no_clamp, args.jobs):
+        print(f"Maps written to {path}")
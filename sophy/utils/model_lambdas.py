@@ -1,93 +1,270 @@
+import os
+import re
+import functools
 import numpy as np
 import pandas as pd
-import re
+from caches import atomic_write
+
+
+# lambdas file metadata used to normalize the linear predictor
+META_KEYS = ('linearPredictorNormalizer', 'densityNormalizer', 'entropy')
+OUTPUTS = ('raw', 'logistic', 'cloglog')
+# compiled features are grouped in this order
+FEATURE_TYPES = ('linear', 'quadratic', 'product', 'threshold', 'categorical', 'forward_hinge', 'reverse_hinge')
+MODEL_CACHE_SUFFIX = '.cache.npz'
+MODEL_CACHE_SIZE = 64
+CHUNK_CELLS = 16384  # cells projected at once (feature arrays are features x cells)
+
+
+class MaxentModel:
+    """MaxEnt model compiled to arrays: one entry per nonzero feature, grouped by type (FEATURE_TYPES), with the
+    index of its variable(s), lambda, training range and threshold/level. Projects arrays or raster stacks"""
+    ARRAYS = ('variables', 'var_min', 'var_max', 'categorical', 'groups', 'first', 'second', 'lambdas', 'min', 'max',
+              'value', 'meta')
+
+    def __init__(self, variables: np.ndarray, var_min: np.ndarray, var_max: np.ndarray, categorical: np.ndarray,
+                 groups: np.ndarray, first: np.ndarray, second: np.ndarray, lambdas: np.ndarray, min: np.ndarray,
+                 max: np.ndarray, value: np.ndarray, meta: np.ndarray):
+        self.variables, self.var_min, self.var_max, self.categorical = variables, var_min, var_max, categorical
+        # features of FEATURE_TYPES[i] are groups[i]:groups[i + 1]
+        self.groups, self.first, self.second = groups, first, second
+        self.lambdas, self.min, self.max, self.value = lambdas, min, max, value
+        self.meta = meta  # META_KEYS values
+
+    @classmethod
+    def from_lambdas(cls, lambdas: tuple[pd.DataFrame, dict]) -> 'MaxentModel':
+        """Compiles parse_lambdas() output"""
+        features, meta = lambdas
+        missing = set(META_KEYS) - set(meta.keys())
+        if len(missing) > 0:
+            raise ValueError(f'Lambdas metadata missing: {", ".join(sorted(missing))}')
+        # variables of every feature (both of a product), linear features give their training range. Variables
+        # without a linear feature (categorical layers, or the linear term dropped) aren't clamped
+        linear = features[features['type'] == 'linear']
+        names = features['feature'].str.split('*').explode()
+        variables = np.array(list(dict.fromkeys([*linear['feature'], *names])), dtype=str)
+        index = {name: i for i, name in enumerate(variables)}
+        limits = linear.set_index('feature')[['min', 'max']].reindex(variables)
+        features = features[features['lambda'] != 0].copy()
+        features['order'] = features['type'].map({typ: i for i, typ in enumerate(FEATURE_TYPES)}).astype(int)
+        features = features.sort_values('order', kind='stable')
+        pairs = features['feature'].str.split('*')
+        return cls(variables=variables, var_min=limits['min'].fillna(-np.inf).to_numpy(),
+                   var_max=limits['max'].fillna(np.inf).to_numpy(),
+                   categorical=np.isin(variables, features.loc[features['type'] == 'categorical', 'feature']),
+                   groups=np.searchsorted(features['order'].to_numpy(), np.arange(len(FEATURE_TYPES) + 1)),
+                   first=np.array([index[pair[0]] for pair in pairs], dtype=np.int32),
+                   second=np.array([index[pair[-1]] for pair in pairs], dtype=np.int32),
+                   lambdas=features['lambda'].to_numpy(), min=features['min'].to_numpy(),
+                   max=features['max'].to_numpy(), value=features['value'].to_numpy(),
+                   meta=np.array([meta[key] for key in META_KEYS]))
+
+    def save(self, path: str, **extra: np.ndarray):
+        """Writes the model arrays (and extra arrays) to a .npz file"""
+        np.savez_compressed(path, **{name: getattr(self, name) for name in self.ARRAYS}, **extra)
+
+    @classmethod
+    def load(cls, path: str) -> 'MaxentModel':
+        """Model written by save()"""
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def linear_predictor(self, newdata, clamp: bool = True) -> np.ndarray:
+        """Log of the raw output (sum of lambda * feature - linearPredictorNormalizer - log(densityNormalizer)).
+        newdata maps every variable of the model to an array (DataFrame columns, or same shape raster grids of a
+        stack), the result has the shape of the arrays and is NaN where any variable is NaN"""
+        return self.batch.project(newdata, None, clamp)[0]
+
+    def project(self, newdata, output: str = 'cloglog', clamp: bool = True) -> np.ndarray:
+        """MaxEnt prediction over newdata (see linear_predictor) as the Java program computes it: 'raw', 'logistic'
+        or 'cloglog' output. Clamping restricts variables and features to their training range"""
+        return self.batch.project(newdata, output, clamp)[0]
+
+    @functools.cached_property
+    def batch(self) -> 'ModelBatch':
+        """Batch of this model alone, which evaluates it"""
+        return ModelBatch([self])
+
+
+class ModelBatch:
+    """Models evaluated together (ex: every class of a season), on blocks of cells.
+    The features of one variable (linear, quadratic, threshold and hinge) sum to a piecewise polynomial of the
+    variable. Its breakpoints are shared by all models, so each cell's segment is found once per variable, and
+    every model adds the polynomial of that segment from a models x segments table. Product and categorical
+    features are computed into a features x cells matrix and summed with a models x features matrix of lambdas"""
+
+    def __init__(self, models: list[MaxentModel]):
+        self.models = models
+        self.variables = np.unique(np.concatenate([model.variables for model in models]))
+        # variable limits of each model (categorical variables aren't clamped)
+        self.lower = np.full((len(models), len(self.variables)), -np.inf)
+        self.upper = np.full((len(models), len(self.variables)), np.inf)
+        parts: list = []
+        for model_index, model in enumerate(models):
+            index = np.searchsorted(self.variables, model.variables)
+            self.lower[model_index, index] = np.where(model.categorical, -np.inf, model.var_min)
+            self.upper[model_index, index] = np.where(model.categorical, np.inf, model.var_max)
+            types = np.repeat(np.arange(len(FEATURE_TYPES)), np.diff(model.groups))
+            parts.append({'model': np.full(len(types), model_index), 'type': types, 'first': index[model.first],
+                          'second': index[model.second], 'lambdas': model.lambdas, 'min': model.min,
+                          'max': model.max, 'value': model.value})
+        features = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+        univariate = ~np.isin(features['type'], [FEATURE_TYPES.index('product'), FEATURE_TYPES.index('categorical')])
+        self.tables = {clamp: [self.segment_table(variable, {key: values[univariate & (features['first'] == variable)]
+                                                             for key, values in features.items()}, clamp)
+                               for variable in range(len(self.variables))] for clamp in (True, False)}
+        # product and categorical features, ordered by type
+        other = {key: values[~univariate] for key, values in features.items()}
+        order = np.argsort(other['type'], kind='stable')
+        other = {key: values[order] for key, values in other.items()}
+        self.types = [FEATURE_TYPES[typ] for typ in other['type']]
+        # rows of the models x variables stack of clamped variables
+        self.first = other['model'] * len(self.variables) + other['first']
+        self.second = other['model'] * len(self.variables) + other['second']
+        self.min, self.max, self.value = (other[key][:, None] for key in ('min', 'max', 'value'))
+        # features are scaled to [0, 1] on their training range: clamped to [0, max - min] before the sum and the
+        # weights are lambda / (max - min)
+        self.span = self.max - self.min
+        self.weights = np.zeros((len(models), len(self.first)))
+        self.weights[other['model'], np.arange(len(self.first))] = other['lambdas'] / self.span[:, 0]
+        meta = np.array([model.meta for model in models])
+        self.offsets = (meta[:, 0] + np.log(meta[:, 1]))[:, None]
+        self.entropy = meta[:, 2, None]
+
+    def segment_table(self, variable: int, features: dict, clamp: bool) -> tuple[np.ndarray, np.ndarray]:
+        """Breakpoints of the variable and polynomial coefficients (3 x models x segments: constant, x, x^2) of the
+        sum of the lambda-weighted features of each model over the segments (breakpoint i - 1, breakpoint i]"""
+        points = [features['value'][features['type'] == FEATURE_TYPES.index('threshold')]]
+        for typ in ('forward_hinge', 'reverse_hinge') + (('linear',) if clamp else ()):
+            points += [features[key][features['type'] == FEATURE_TYPES.index(typ)] for key in ('min', 'max')]
+        if clamp:
+            quadratic = features['type'] == FEATURE_TYPES.index('quadratic')
+            roots = np.sqrt(np.maximum(np.concatenate([features['min'][quadratic], features['max'][quadratic]]), 0))
+            points += [roots, -roots, self.lower[:, variable], self.upper[:, variable]]
+        breaks = np.unique(np.concatenate(points))
+        breaks = breaks[np.isfinite(breaks)]
+        # a point inside each segment, every feature is one polynomial on a segment
+        inside = np.concatenate([breaks[:1] - 1, (breaks[1:] + breaks[:-1]) / 2, breaks[-1:] + 1]) if len(breaks) \
+            else np.zeros(1)
+        coefficients = np.zeros((3, len(self.models), len(inside)))
+        for model, typ, fmin, fmax, value, weight in zip(features['model'], features['type'], features['min'],
+                                                           features['max'], features['value'],
+                                                           features['lambdas'] / (features['max'] - features['min'])):
+            x = np.clip(inside, self.lower[model, variable], self.upper[model, variable]) if clamp else inside
+            zero = np.zeros(len(x))
+            typ = FEATURE_TYPES[typ]
+            # feature value minus its minimum and its polynomial
+            if typ == 'linear':
+                values, polynomial = x - fmin, (zero - fmin, zero + 1, zero)
+            elif typ == 'quadratic':
+                values, polynomial = x ** 2 - fmin, (zero - fmin, zero, zero + 1)
+            elif typ == 'threshold':
+                values = (x > value) - fmin
+                polynomial = (values, zero, zero)
+            elif typ == 'forward_hinge':
+                values = np.maximum(x - fmin, 0)
+                polynomial = (np.where(x > fmin, -fmin, 0), (x > fmin).astype(float), zero)
+            else:
+                values = np.maximum(fmax - x, 0)
+                polynomial = (np.where(x < fmax, fmax, 0), -(x < fmax).astype(float), zero)
+            if clamp:
+                # constant where the variable or the feature is clamped
+                constant = (x != inside) | (values <= 0) | (values >= fmax - fmin)
+                values = np.clip(values, 0, fmax - fmin)
+                polynomial = [np.where(constant, values if degree == 0 else 0, part)
+                              for degree, part in enumerate(polynomial)]
+            coefficients[:, model] += weight * np.array(polynomial)
+        return breaks, coefficients
+
+    def project(self, newdata, output: str = 'cloglog', clamp: bool = True, out: np.ndarray = None) -> np.ndarray:
+        """Prediction of every model over newdata (see MaxentModel.project), models x the shape of the arrays.
+        output None is the linear predictor. Blocks of cells are written to out (ex: a memory-mapped array) if given"""
+        missing = set(self.variables) - set(newdata.keys())
+        if len(missing) > 0:
+            raise ValueError(f'Variables missing in newdata: {", ".join(sorted(missing))}')
+        env: list = [np.asarray(newdata[name], dtype=float) for name in self.variables]
+        shape: tuple = np.broadcast_shapes(*(values.shape for values in env))
+        env: np.ndarray = np.stack([np.broadcast_to(values, shape).ravel() for values in env])
+        out = np.empty((len(self.models), *shape)) if out is None else out
+        flat: np.ndarray = out.reshape(len(self.models), -1)
+        # cells with a missing variable (ex: land) are skipped
+        valid: np.ndarray = ~np.isnan(env).any(axis=0)
+        flat[:, ~valid] = np.nan
+        cells: np.ndarray = np.flatnonzero(valid)
+        features: np.ndarray = np.empty((len(self.first), min(CHUNK_CELLS, len(cells))))
+        for start in range(0, len(cells), CHUNK_CELLS):
+            block = cells[start:start + CHUNK_CELLS]
+            predictor = self.polynomial_sum(env[:, block], clamp) - self.offsets
+            if len(self.first) > 0:
+                predictor += self.weights @ self.feature_values(env[:, block], clamp, features[:, :len(block)])
+            flat[:, block] = predictor if output is None else transform_output(predictor, self.entropy, output)
+        return out
+
+    def polynomial_sum(self, env: np.ndarray, clamp: bool) -> np.ndarray:
+        """Sum of the lambda-weighted features of one variable (models x cells) of the cells of env"""
+        total: np.ndarray = np.zeros((len(self.models), env.shape[1]))
+        for x, (breaks, coefficients) in zip(env, self.tables[clamp]):
+            segment = np.searchsorted(breaks, x, side='left')
+            constant, linear, quadratic = (part[:, segment] for part in coefficients)
+            quadratic *= x
+            quadratic += linear
+            quadratic *= x
+            total += constant
+            total += quadratic
+        return total
+
+    def feature_values(self, env: np.ndarray, clamp: bool, out: np.ndarray) -> np.ndarray:
+        """Product and categorical features (features x cells) of the cells of env (variables x cells) minus their
+        training minimum, written to out"""
+        stack: np.ndarray = np.tile(env, (len(self.models), 1))
+        if clamp:
+            np.clip(stack, self.lower.reshape(-1, 1), self.upper.reshape(-1, 1), out=stack)
+        np.take(stack, self.first, axis=0, out=out)
+        products = np.array([typ == 'product' for typ in self.types])
+        out[products] *= stack[self.second[products]]
+        out[~products] = out[~products] == self.value[~products]
+        out -= self.min
+        if clamp:
+            np.clip(out, 0, self.span, out=out)
+        return out
+
+
+def transform_output(predictor: np.ndarray, entropy: np.ndarray, output: str) -> np.ndarray:
+    """'raw', 'logistic' or 'cloglog' output of linear predictors"""
+    assert output in OUTPUTS, f'output is one of {OUTPUTS}, not {output}'
+    raw: np.ndarray = np.exp(predictor)
+    if output == 'raw':
+        return raw
+    scaled: np.ndarray = raw * np.exp(entropy)
+    if output == 'logistic':
+        return scaled / (1 + scaled)
+    return 1 - np.exp(-scaled)
+
+
+def project(lambdas: tuple[pd.DataFrame, dict], newdata, output: str = 'cloglog', clamp: bool = True) -> np.ndarray:
+    """MaxEnt prediction of parse_lambdas() output over newdata (see MaxentModel.project)"""
+    return MaxentModel.from_lambdas(lambdas).project(newdata, output, clamp)
+
+
+def load_model(lambdas_file: str) -> MaxentModel:
+    """Compiled model of a .lambdas file, shared by every caller in this process while the file is unchanged"""
+    return compiled_model(os.path.abspath(lambdas_file), os.path.getmtime(lambdas_file))
 
 
-# def project(lambdas, newdata, return_lfx=False, mask=None, quiet=False):
-#
-#   meta = lambdas[1:]
-#   lambdas = lambdas[0]
-#
-#   is_cat = lambdas[lambdas["type"] == "categorical", "feature"].unique()
-#   nms = np.unique(np.concatenate([lambdas["var"][lambdas["lambda"] != 0].str.split(", ").explode()]))
-#   clamp_limits = lambdas[lambdas["type"] == "linear", ["feature", "min", "max"]]
-#   lambdas = lambdas[lambdas["lambda"] != 0]
-#   lambdas = lambdas.groupby(lambdas["type"].ne("hinge").cumsum()).apply(lambda x: x.drop("type", axis=1))
-#
-#   missing_vars = set(nms) - set(newdata.columns)
-#   if len(missing_vars) > 0:
-#       raise ValueError("Variables missing in newdata: " + ", ".join(missing_vars))
-#
-#   newdata = newdata[nms]
-#   na = newdata.isnull().any(axis=1)
-#   newdata = newdata.dropna()
-#
-#   def clamp_features(row):
-#       x = row[feature]
-#       clamp_max = clamp_limits[clamp_limits["feature"] == feature]["max"]
-#       clamp_min = clamp_limits[clamp_limits["feature"] == feature]["min"]
-#       row[feature] = max(min(x, clamp_max), clamp_min)
-#       return row
-#
-#   for feature in set(nms) - set(is_cat):
-#       newdata = newdata.apply(clamp_features, axis=1)
-#
-#   k_hinge = len(lambdas[lambdas["type"] == "hinge"])
-#   k_other = len(lambdas[lambdas["type"] != "hinge"])
-#
-#   def categorical_features(row):
-#     for feature in is_cat:
-#         levels = lambdas[lambdas["feature"] == feature, "level"].unique()
-#         for level in levels:
-#             row[feature + "_" + level] = (row[feature] == level)
-#     return row
-#
-#   newdata = newdata.apply(categorical_features, axis=1)
-#
-#   pred_lin = np.zeros((newdata.shape[0], k_other))
-#   pred_quad = np.zeros((newdata.shape[0], k_other))
-#   pred_cub = np.zeros((newdata.shape[0], k_other))
-#   pred_hinge = np.zeros((newdata.shape[0], k_hinge))
-#
-#   for i, lambda_row in enumerate(lambdas.itertuples(index=False)):
-#       feature = lambda_row.feature
-#       var = lambda_row.var
-#       typ = lambda_row.type
-#       if typ == "linear":
-#           pred_lin[:, i] = lambda_row.lambda * newdata[var]
-#       elif typ == "quadratic":
-#           pred_quad[:, i] = lambda_row.lambda * newdata[var] ** 2
-#       elif typ == "cubic":
-#           pred_cub[:, i] = lambda_row.lambda * newdata[var] ** 3
-#       elif typ == "hinge":
-#           level = lambda_row.level
-#           pred_hinge[:, i] = lambda_row.lambda * (newdata[var] >= level)
-#
-#   lin_pred = np.sum(pred_lin, axis=1)
-#   quad_pred = np.sum(pred_quad, axis=1)
-#   cub_pred = np.sum(pred_cub, axis=1)
-#   hinge_pred = np.sum(pred_hinge, axis=1)
-#
-#   pred = np.exp(lin_pred + quad_pred + cub_pred + hinge_pred)
-#
-#   if return_lfx:
-#       pred_lfx = np.exp(lin_pred + quad_pred + cub_pred + hinge_pred)
-#
-#   if mask is not None:
-#       pred_raw = 0
-#       pred_logistic = 0
-#       pred_cloglog = 0
-#       pred_raw[~na] = pred
-#       pred_logistic[~na] = 1 / (1 + np.exp(-pred))
-#       pred_cloglog[~na] = 1 - np.exp(-np.exp(pred))
-#
-#   if not quiet:
-#       print("Done.")
-#
-#   if return_lfx:
-#       return pred_raw, pred_logistic, pred_cloglog, pred_lfx
-#   else:
-#       return pred_raw, pred_logistic, pred_cloglog
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def compiled_model(lambdas_file: str, mtime: float) -> MaxentModel:
+    """Compiled model of a .lambdas file, from the .npz cache next to it when it is up to date.
+    The cache is written the first time the file is compiled after it changed (keyed by its mtime)"""
+    cache_file = lambdas_file + MODEL_CACHE_SUFFIX
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as arrays:
+            current = 'mtime' in arrays and arrays['mtime'] == mtime
+        if current:
+            return MaxentModel.load(cache_file)
+    model = MaxentModel.from_lambdas(parse_lambdas(lambdas_file))
+    with atomic_write(cache_file) as temp_file:
+        model.save(temp_file, mtime=np.array(mtime))
+    return model
 
 
 def parse_lambdas(lambdas_file: str) -> tuple[pd.DataFrame, dict]:
@@ -110,15 +287,22 @@ def parse_lambdas(lambdas_file: str) -> tuple[pd.DataFrame, dict]:
             prefix: str = re.sub("\\w|\\.|-|\\(|\\)", "", feature)
             # replace prefix with feature type (no prefix means its linear)
             typ: str = prefix_to_type[prefix] if prefix in prefix_to_type else 'linear'
-            # remove the prefix from the feature
-            feature: str = re.sub('\\^2|\\(.*?<=|\\((.*?)==.*?|`|\\\'|\\)', "\\1", feature)
-            parsed.append([feature, typ, float(_lambda), float(min), float(max)])
+            # threshold and categorical features keep their threshold/level in value
+            value: float = np.nan
+            if typ == 'threshold':
+                value, feature = re.fullmatch('\\((.*)<=(.*)\\)', feature).groups()
+            elif typ == 'categorical':
+                feature, value = re.fullmatch('\\((.*)==(.*)\\)', feature).groups()
+            else:
+                # remove the prefix from the feature
+                feature: str = re.sub('\\^2|`|\\\'', "", feature)
+            parsed.append([feature, typ, float(_lambda), float(min), float(max), float(value)])
         elif len(parts) == 2:
             # if there are 2 parts, it's a metadata line
             key, value = parts
             meta[key] = float(value)
 
-    parsed_df = pd.DataFrame(parsed, columns=['feature', 'type', 'lambda', 'min', 'max'])
+    parsed_df = pd.DataFrame(parsed, columns=['feature', 'type', 'lambda', 'min', 'max', 'value'])
     parsed_df['type'] = pd.Categorical(parsed_df['type'])
     # return the parsed dataframe and the metadata
     return parsed_df, meta
@@ -0,0 +1,83 @@
+"""Streams the presence points of every phytoplankton class out of the sophy database into the seasonal samples
+files of MaxEnt (class, x, y in the projection of the environmental layers). Rows are read, reprojected and
+deduplicated to the grid cells of the layers in bounded chunks, so memory use doesn't grow with the database"""
+
+import os
+import sqlite3
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from export import connect_readonly, CHUNK_ROWS
+from rasters import layer_names, load_layer, cell_indices, GRID_CRS
+from maxent_fit import LAYERS_DIR, PRESENCE_FILE
+
+# austral seasons by month
+SEASONS = {"summer": (12, 1, 2), "autumn": (3, 4, 5), "winter": (6, 7, 8), "spring": (9, 10, 11)}
+# occurrences and counted sample amounts (amounts of 0 are absences) of taxa with a class
+PRESENCE_QUERY = """
+SELECT taxonomy.class, occurrence.longitude, occurrence.latitude, CAST(strftime('%m', occurrence.date_time) AS INTEGER)
+FROM occurrence JOIN taxonomy ON taxonomy.aphia_id = occurrence.aphia_id
+WHERE taxonomy.class IS NOT NULL AND occurrence.date_time IS NOT NULL
+UNION ALL
+SELECT taxonomy.class, sample.longitude, sample.latitude, CAST(strftime('%m', sample.date_time) AS INTEGER)
+FROM sample_amount JOIN sample ON sample.id = sample_amount.sample_id
+JOIN taxonomy ON taxonomy.aphia_id = sample_amount.aphia_id
+WHERE taxonomy.class IS NOT NULL AND sample.date_time IS NOT NULL
+AND coalesce(cells_per_L, count_per_L, biomass_per_L, biovolume_per_L, 1) > 0
+"""
+
+
+def presence_chunks(con: sqlite3.Connection, chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Class, longitude, latitude and month of the presence rows, chunk_rows at a time"""
+    cursor = con.cursor()
+    cursor.row_factory = None
+    cursor.execute(PRESENCE_QUERY)
+    while rows := cursor.fetchmany(chunk_rows):
+        yield pd.DataFrame(rows, columns=["class", "longitude", "latitude", "month"])
+
+
+def export_presence(db_path: str, out_dir: str, layers_dir: str = LAYERS_DIR, classes: tuple[str] = None,
+                    crs: str = GRID_CRS, chunk_rows: int = CHUNK_ROWS) -> dict[str, int]:
+    """Writes the presence points of each season to out_dir/sophy_mercator_<season>.csv (class, longitude, latitude
+    columns holding x and y in crs, the MaxEnt samples format). Only the first point of a class in a grid cell of the
+    season's layers (layers_dir/<season>/) is kept and points outside the grid are dropped. Every class is exported
+    unless classes are given. Every chunk is reprojected by one transformer and appended to the files.
+    Returns the number of points of each season"""
+    os.makedirs(out_dir, exist_ok=True)
+    transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    season_of_month = np.empty(13, dtype=object)
+    for season, months in SEASONS.items():
+        season_of_month[list(months)] = season
+    headers, files, counts = {}, {}, {}
+    for season in SEASONS:
+        layer_dir = os.path.join(layers_dir, season)
+        headers[season] = load_layer(layer_dir, layer_names(layer_dir)[0])[1]
+        files[season] = open(os.path.join(out_dir, PRESENCE_FILE.format(season=season)), "w", newline="")
+        files[season].write("class,longitude,latitude\n")
+        counts[season] = 0
+    # sorted cells already holding a point of each (season, class), at most every cell of the grid
+    seen: dict[tuple[str, str], np.ndarray] = {}
+    con = connect_readonly(db_path)
+    for chunk in presence_chunks(con, chunk_rows):
+        chunk = chunk.dropna(subset=["longitude", "latitude", "month"])
+        if classes is not None:
+            chunk = chunk[chunk["class"].isin(classes)]
+        chunk["longitude"], chunk["latitude"] = transformer.transform(chunk["longitude"].to_numpy(),
+                                                                      chunk["latitude"].to_numpy())
+        chunk["season"] = season_of_month[chunk["month"].to_numpy(dtype=int)]
+        for (season, name), rows in chunk.groupby(["season", "class"], sort=False):
+            header = headers[season]
+            row, col = cell_indices(header, rows["longitude"].to_numpy(), rows["latitude"].to_numpy())
+            cells = row * header["ncols"] + col
+            # first point of each new cell of the chunk
+            cells, first = np.unique(cells, return_index=True)
+            new = (cells >= 0) & ~np.isin(cells, seen.get((season, name), ()), assume_unique=True)
+            seen[(season, name)] = np.union1d(seen.get((season, name), cells[:0]), cells[new])
+            rows = rows.iloc[np.sort(first[new])]
+            rows[["class", "longitude", "latitude"]].to_csv(files[season], header=False, index=False)
+            counts[season] += len(rows)
+    con.close()
+    for file in files.values():
+        file.close()
+    return counts
@@ -0,0 +1,159 @@
+"""Composable queries of the sophy database, returned as Arrow tables or NumPy arrays.
+Queries run on a thread-safe pool of read-only connections that keep their prepared statements"""
+
+import queue
+import sqlite3
+import threading
+import contextlib
+from typing import Iterator
+import numpy as np
+import pyarrow as pa
+import shapely
+from export import arrow_schema, connect_readonly
+
+POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+QUERY_TABLES = ("sample", "occurrence")
+THRESHOLD_OPS = ("<", "<=", ">", ">=", "=", "!=")
+TAXONOMY_RANKS = ("superkingdom", "kingdom", "phylum", "subphylum", "superclass", "class", "subclass", "superorder",
+                  "order_", "suborder", "infraorder", "superfamily", "family", "genus", "species", "scientific_name")
+
+
+class Query:
+    """Filters of sample or occurrence rows. Every filter returns a new Query, so queries can be shared and extended.
+    Ex: Query("sample").sector("Weddell").date_range("2000-01-01", "2010-01-01").threshold("hplc_fuco", ">", 0.1)"""
+
+    def __init__(self, table: str = "sample", columns: tuple[str] = (), filters: tuple = (),
+                 polygon: shapely.Geometry = None):
+        assert table in QUERY_TABLES, f"queries are on one of {QUERY_TABLES}, not {table}"
+        self.table, self.columns, self.filters, self.polygon_filter = table, tuple(columns), tuple(filters), polygon
+
+    def _extend(self, sql: str, params: tuple = (), columns: tuple[str] = ()) -> "Query":
+        """New Query with one more filter. columns are the names in sql (checked against the schema)"""
+        return Query(self.table, self.columns, self.filters + ((sql, tuple(params), tuple(columns)),),
+                     self.polygon_filter)
+
+    def select(self, *columns: str) -> "Query":
+        """Only return these columns (all columns by default)"""
+        return Query(self.table, columns, self.filters, self.polygon_filter)
+
+    def bbox(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> "Query":
+        """Rows inside a latitude/longitude box, found through the R*Tree index of the table"""
+        return self._extend(f"id IN (SELECT id FROM {self.table}_rtree WHERE max_lat >= ? AND min_lat <= ? "
+                            f"AND max_lon >= ? AND min_lon <= ?) AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?",
+                            (lat_min, lat_max, lon_min, lon_max, lat_min, lat_max, lon_min, lon_max))
+
+    def polygon(self, geometry: shapely.Geometry) -> "Query":
+        """Rows inside a polygon of longitude/latitude coordinates. The database returns the rows in the polygon's
+        bounding box, the exact test runs on the result arrays"""
+        lon_min, lat_min, lon_max, lat_max = geometry.bounds
+        query = self.bbox(lat_min, lat_max, lon_min, lon_max)
+        if self.polygon_filter is not None:
+            geometry = shapely.intersection(self.polygon_filter, geometry)
+        return Query(query.table, query.columns, query.filters, geometry)
+
+    def front_zone(self, *zones: str) -> "Query":
+        """Rows in any of the frontal zones (see zones.py)"""
+        return self._extend(f"front_zone IN ({', '.join('?' * len(zones))})", zones)
+
+    def sector(self, *sectors: str) -> "Query":
+        """Rows in any of the sectors"""
+        return self._extend(f"sector IN ({', '.join('?' * len(sectors))})", sectors)
+
+    def date_range(self, start: str = None, end: str = None) -> "Query":
+        """Rows with start <= date_time < end (ISO 8601 strings, either bound can be left open)"""
+        query = self
+        if start is not None:
+            query = query._extend("date_time >= ?", (start,))
+        if end is not None:
+            query = query._extend("date_time < ?", (end,))
+        return query
+
+    def taxon(self, rank: str, name: str) -> "Query":
+        """Rows of a taxon, ex: taxon("genus", "Phaeocystis"). Samples match if any of their amounts is of the taxon"""
+        assert rank in TAXONOMY_RANKS, f"{rank} is not one of the taxonomy ranks {TAXONOMY_RANKS}"
+        if rank == "scientific_name":
+            taxa, params = "SELECT aphia_id FROM taxonomy WHERE scientific_name = ?", (name,)
+        else:
+            taxa, params = "SELECT aphia_id FROM taxonomy_closure WHERE rank = ? AND name = ?", (rank, name)
+        if self.table == "sample":
+            return self._extend(f"id IN (SELECT sample_id FROM sample_amount WHERE aphia_id IN ({taxa}))", params)
+        return self._extend(f"aphia_id IN ({taxa})", params)
+
+    def threshold(self, column: str, op: str, value: float) -> "Query":
+        """Rows where a measured column (ex: a pigment) compares to a value, ex: threshold("hplc_fuco", ">", 0.1)"""
+        assert op in THRESHOLD_OPS, f"{op} is not one of {THRESHOLD_OPS}"
+        return self._extend(f'"{column}" {op} ?', (value,), (column,))
+
+    def sql(self, table_columns: list[str]) -> tuple[str, tuple]:
+        """SELECT statement and parameters of the query. Column names are checked against table_columns"""
+        columns = list(self.columns or table_columns)
+        if self.polygon_filter is not None:
+            columns += [col for col in ("latitude", "longitude") if col not in columns]
+        for column in columns + [col for _, _, names in self.filters for col in names]:
+            assert column in table_columns, f"{self.table} has no column {column}"
+        where = " AND ".join(f"({sql})" for sql, _, _ in self.filters) or "1"
+        params = tuple(param for _, params, _ in self.filters for param in params)
+        quoted = ", ".join(f'"{col}"' for col in columns)
+        return f"SELECT {quoted} FROM {self.table} WHERE {where}", params
+
+
+class ConnectionPool:
+    """Read-only connections to a sophy database shared by threads. Each connection is used by one thread at a time
+    and keeps its prepared statements, so repeated queries skip parsing and planning"""
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE):
+        self.db_path, self.size = db_path, size
+        self.idle, self.opened, self.lock = queue.LifoQueue(), 0, threading.Lock()
+        with self.connection() as con:
+            self.schemas = {table: arrow_schema(con, table) for table in QUERY_TABLES}
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrows a connection, opening a new one while fewer than size are open"""
+        try:
+            con = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.opened < self.size
+                self.opened += create
+            con = connect_readonly(self.db_path, STATEMENT_CACHE_SIZE) if create else self.idle.get()
+        try:
+            yield con
+        finally:
+            self.idle.put(con)
+
+    def arrow(self, query: Query) -> pa.Table:
+        """Result of a query as an Arrow table, typed by the column types of schema.sql"""
+        schema = self.schemas[query.table]
+        sql, params = query.sql(schema.names)
+        with self.connection() as con:
+            table = fetch_arrow(con, sql, params)
+        table = table.cast(pa.schema([schema.field(name) for name in table.column_names]))
+        if query.polygon_filter is not None:
+            inside = shapely.contains_xy(query.polygon_filter, table["longitude"].to_numpy(zero_copy_only=False),
+                                         table["latitude"].to_numpy(zero_copy_only=False))
+            table = table.filter(inside)
+            if query.columns:
+                table = table.select(list(query.columns))
+        return table
+
+    def numpy(self, query: Query) -> dict[str, np.ndarray]:
+        """Result of a query as one NumPy array per column (NULL is NaN in REAL columns)"""
+        table = self.arrow(query)
+        return {name: column.to_numpy() for name, column in zip(table.column_names, table.combine_chunks().columns)}
+
+    def close(self):
+        """Closes the idle connections"""
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+            self.opened -= 1
+
+
+def fetch_arrow(con: sqlite3.Connection, sql: str, params: tuple) -> pa.Table:
+    """Rows of a statement as an Arrow table, converted column by column"""
+    cursor = con.execute(sql, params)
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    columns = zip(*rows) if rows else [[] for _ in names]
+    return pa.table([pa.array(column) for column in columns], names=names)
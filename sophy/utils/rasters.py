@@ -0,0 +1,144 @@
+"""Reads the environmental rasters used by the MaxEnt models: ESRI ASCII grids (.asc) and the binary copies MaxEnt
+keeps of them in maxent.cache/ (.mxe). Layers are parsed once into memory-mapped .npy caches next to them"""
+
+import os
+import glob
+import gzip
+import json
+import struct
+import numpy as np
+from caches import atomic_write
+
+ASC_HEADER_KEYS = ("ncols", "nrows", "xllcorner", "yllcorner", "cellsize", "nodata_value")
+MXE_CACHE_DIR = "maxent.cache"
+# Java serialization stream: magic and version, then the grid written in blocks of data
+JAVA_STREAM_HEADER = b"\xac\xed\x00\x05"
+JAVA_BLOCK_DATA = 0x77
+JAVA_BLOCK_DATA_LONG = 0x7a
+# MXE header: xll, yll, cell size, rows, columns, nodata, value type. Values are rows from the top
+MXE_HEADER = struct.Struct(">3d4i")
+MXE_TYPES = {1: ">f4"}  # the only type the BSOSE layers use
+# the BSOSE layers are on a World Mercator grid (their .prj files say WGS84)
+GRID_CRS = "EPSG:3395"
+LAYER_CACHE_SUFFIX = ".cache.npy"
+LAYER_HEADER_SUFFIX = ".cache.json"
+
+
+def read_asc(path: str) -> tuple[np.ndarray, dict]:
+    """Grid (rows from the top, nodata is NaN) and header of an ESRI ASCII raster"""
+    header = {}
+    with open(path, "r") as file:
+        # NODATA_value is optional
+        while len(header) < len(ASC_HEADER_KEYS):
+            position, parts = file.tell(), file.readline().split()
+            if len(parts) != 2 or not parts[0][0].isalpha():
+                file.seek(position)
+                break
+            header[parts[0].lower()] = float(parts[1])
+        grid = np.loadtxt(file, dtype=np.float32, ndmin=2)
+    for axis in ("x", "y"):
+        if f"{axis}llcenter" in header:
+            header[f"{axis}llcorner"] = header.pop(f"{axis}llcenter") - header["cellsize"] / 2
+    header = raster_header(header)
+    grid[grid == header["nodata_value"]] = np.nan
+    return grid.reshape(header["nrows"], header["ncols"]), header
+
+
+def read_mxe(path: str) -> tuple[np.ndarray, dict]:
+    """Grid (rows from the top, nodata is NaN) and header of a MaxEnt .mxe raster (gzipped Java serialization)"""
+    with gzip.open(path, "rb") as file:
+        stream = file.read()
+    assert stream[:4] == JAVA_STREAM_HEADER, f"{path} is not a MaxEnt .mxe file"
+    # concatenate the data blocks
+    blocks, i = [], len(JAVA_STREAM_HEADER)
+    while i < len(stream):
+        if stream[i] == JAVA_BLOCK_DATA:
+            start, size = i + 2, stream[i + 1]
+        elif stream[i] == JAVA_BLOCK_DATA_LONG:
+            start, size = i + 5, struct.unpack(">i", stream[i + 1:i + 5])[0]
+        else:
+            raise ValueError(f"Unexpected Java stream element {stream[i]:#x} in {path}")
+        blocks.append(stream[start:start + size])
+        i = start + size
+    data = b"".join(blocks)
+    xll, yll, cell_size, nrows, ncols, nodata, value_type = MXE_HEADER.unpack_from(data)
+    header = raster_header({"ncols": ncols, "nrows": nrows, "xllcorner": xll, "yllcorner": yll,
+                            "cellsize": cell_size, "nodata_value": nodata})
+    if value_type not in MXE_TYPES:
+        raise ValueError(f"Unsupported .mxe value type {value_type} in {path}")
+    grid = np.frombuffer(data, MXE_TYPES[value_type], nrows * ncols, MXE_HEADER.size).astype(np.float32)
+    grid[grid == nodata] = np.nan
+    return grid.reshape(nrows, ncols), header
+
+
+def raster_header(header: dict) -> dict:
+    """Header with integer grid sizes and a nodata value (-9999 by default)"""
+    return {**header, "ncols": int(header["ncols"]), "nrows": int(header["nrows"]),
+            "nodata_value": header.get("nodata_value", -9999)}
+
+
+def layer_source(layer_dir: str, name: str) -> str:
+    """Path of the layer name.asc in layer_dir, or of MaxEnt's cached copy if the .asc isn't there"""
+    asc_path = os.path.join(layer_dir, f"{name}.asc")
+    return asc_path if os.path.exists(asc_path) else os.path.join(layer_dir, MXE_CACHE_DIR, f"{name}.mxe")
+
+
+def layer_names(layer_dir: str) -> list[str]:
+    """Names of the layers in layer_dir: its .asc files, or MaxEnt's cached copies if there are none"""
+    paths = glob.glob(os.path.join(layer_dir, "*.asc")) or glob.glob(os.path.join(layer_dir, MXE_CACHE_DIR, "*.mxe"))
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in paths)
+
+
+def read_layer(layer_dir: str, name: str) -> tuple[np.ndarray, dict]:
+    """Grid and header of a layer (see layer_source), parsed from its source file"""
+    source = layer_source(layer_dir, name)
+    return read_asc(source) if source.endswith(".asc") else read_mxe(source)
+
+
+def load_layer(layer_dir: str, name: str) -> tuple[np.ndarray, dict]:
+    """Memory-mapped float32 grid (read-only, nodata is NaN) and header of a layer. The grid is parsed the first
+    time the layer is loaded after its source changed (keyed by the source mtime) and stored next to it as .npy,
+    with the grid header, the CRS of its .prj file and the source in a .json header"""
+    source = layer_source(layer_dir, name)
+    cache_file = os.path.join(layer_dir, name + LAYER_CACHE_SUFFIX)
+    header_file = os.path.join(layer_dir, name + LAYER_HEADER_SUFFIX)
+    mtime = os.path.getmtime(source)
+    if os.path.exists(cache_file) and os.path.exists(header_file):
+        with open(header_file, "r") as file:
+            header = json.load(file)
+        if header["source"] == os.path.relpath(source, layer_dir) and header["mtime"] == mtime:
+            return np.load(cache_file, mmap_mode="r"), header
+    grid, header = read_layer(layer_dir, name)
+    prj_path = os.path.join(layer_dir, f"{name}.prj")
+    crs = open(prj_path, "r").read().strip() if os.path.exists(prj_path) else None
+    header |= {"crs": crs, "source": os.path.relpath(source, layer_dir), "mtime": mtime}
+    # the grid is replaced before its header, a header never describes an older grid
+    with atomic_write(cache_file) as temp_file:
+        np.save(temp_file, grid)
+    with atomic_write(header_file) as temp_file, open(temp_file, "w") as file:
+        json.dump(header, file)
+    return np.load(cache_file, mmap_mode="r"), header
+
+
+def grid_header(header: dict) -> dict:
+    """Size, origin and cell size of a layer header (layers with the same grid header are aligned)"""
+    return {key: header[key] for key in ASC_HEADER_KEYS}
+
+
+def sample_layers(layer_dir: str, names: list[str], x: np.ndarray, y: np.ndarray) -> dict[str, np.ndarray]:
+    """Values of the layers at the points (x, y), NaN outside the grid. Only the pages of the cached grids that
+    hold the points are read"""
+    values = {}
+    for name in names:
+        grid, header = load_layer(layer_dir, name)
+        row, col = cell_indices(header, x, y)
+        values[name] = np.where(row >= 0, grid[row, col], np.nan)
+    return values
+
+
+def cell_indices(header: dict, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Row and column of the cells containing the points (x, y), -1 outside the grid"""
+    col = np.floor((np.asarray(x) - header["xllcorner"]) / header["cellsize"]).astype(int)
+    row = header["nrows"] - 1 - np.floor((np.asarray(y) - header["yllcorner"]) / header["cellsize"]).astype(int)
+    outside = (col < 0) | (col >= header["ncols"]) | (row < 0) | (row >= header["nrows"])
+    return np.where(outside, -1, row), np.where(outside, -1, col)
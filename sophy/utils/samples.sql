@@ -42,4 +42,80 @@ set aphia_id = (select aphia_id from microscopy where sample.scientific_name = m
 
 select * from sample where aphia_id is not null limit 50;
 
-select * from microscopy where aphia_id = 248106;
\ No newline at end of file
+select * from microscopy where aphia_id = 248106;
+
+-- queries of the current tables: the queries above that used the old columns, and the workload of the indexes,
+-- spatial indexes and aggregate tables of schema.sql (all selects are timed by benchmark_queries.py)
+
+-- multiple filters on full dataset
+select *
+from sample
+where chemtax_cryptophytes < 0.5 and latitude > -67.0 and latitude < -60.0 and chemtax_prasinophytes > 0.1;
+
+-- amount of every genus
+select count(*) as entries, genus
+from sample_amount, taxonomy
+where sample_amount.aphia_id = taxonomy.aphia_id
+group by genus
+order by entries desc;
+
+-- average salinity from certain region, using the spatial index
+-- (R*Tree bounds are rounded outwards so the exact latitude filter is repeated)
+select avg(salinity)
+from sample_rtree join sample on sample.id = sample_rtree.id
+where sample_rtree.max_lat >= -67 and sample_rtree.min_lat <= -60
+  and sample.latitude > -67 and sample.latitude < -60;
+
+-- samples in a bounding box
+select sample.*
+from sample_rtree join sample on sample.id = sample_rtree.id
+where sample_rtree.max_lat >= -70 and sample_rtree.min_lat <= -60
+  and sample_rtree.max_lon >= -70 and sample_rtree.min_lon <= -50;
+
+-- samples of a zone and sector in a time range
+select *
+from sample
+where front_zone = 'SIZ' and sector = 'Weddell' and date_time between '2000-01-01' and '2010-12-31';
+
+-- facets
+select source_name, count(*) from sample group by source_name;
+
+select front_zone, sector, count(*) from sample group by front_zone, sector;
+
+-- facets from the aggregate tables (maintained by build.py, '' is NULL)
+select front_zone, sector, sum(entries) from agg_count where table_name = 'sample' group by front_zone, sector;
+
+-- monthly mean salinity of a sector
+select year_month, sum(total) / sum(n) as mean
+from agg_sample_value
+where variable = 'salinity' and sector = 'Weddell'
+group by year_month;
+
+-- amounts and biomass per class and zone, through the taxonomy closure (every rank works the same way)
+select taxonomy_closure.name, front_zone, count(*), sum(biomass_per_L)
+from sample_amount
+join taxonomy_closure on taxonomy_closure.aphia_id = sample_amount.aphia_id and taxonomy_closure.rank = 'class'
+join sample on sample.id = sample_amount.sample_id
+group by taxonomy_closure.ancestor_id, front_zone;
+
+-- sample_amount rows of all diatoms
+select sample_amount.*
+from taxonomy_closure join sample_amount on sample_amount.aphia_id = taxonomy_closure.aphia_id
+where taxonomy_closure.rank = 'class' and taxonomy_closure.name = 'Bacillariophyceae';
+
+-- most sampled genera of a zone
+select taxon, sum(amounts) as amounts
+from taxon_rank_count
+where rank = 'genus' and front_zone = 'SIZ'
+group by taxon
+order by amounts desc
+limit 20;
+
+-- amounts of a sample
+select * from sample_amount where sample_id = 1000;
+
+select * from sample_amount where taxa is not null;
+
+select * from occurrence where aphia_id is not null limit 50;
+
+select * from sample_amount where aphia_id = 248106;
@@ -0,0 +1,6 @@
+"""The utils modules import each other by name (they run from sophy/utils), so the tests do the same"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,30 @@
+import numpy as np
+from model_lambdas import MaxentModel, parse_lambdas
+
+# temperature has a linear feature, depth is only a categorical layer and nitrate only a hinge and a product
+LAMBDAS = """temperature, 1.5, -2.0, 8.0
+temperature*nitrate, -0.5, -20.0, 240.0
+(depth=2.0), 0.8, 0.0, 1.0
+'nitrate, 2.0, 5.0, 30.0
+linearPredictorNormalizer, 1.25
+densityNormalizer, 300.0
+numBackgroundPoints, 10000
+entropy, 7.5
+"""
+
+
+def test_variables_without_linear_feature(tmp_path):
+    path = tmp_path / "model.lambdas"
+    path.write_text(LAMBDAS)
+    model = MaxentModel.from_lambdas(parse_lambdas(str(path)))
+    assert list(model.variables) == ["temperature", "nitrate", "depth"]
+    assert model.var_min.tolist() == [-2.0, -np.inf, -np.inf]
+    assert model.var_max.tolist() == [8.0, np.inf, np.inf]
+    assert model.categorical.tolist() == [False, False, True]
+
+    temperature, nitrate, depth = np.array([0.0, 4.0, 6.0]), np.array([3.0, 12.0, 25.0]), np.array([2.0, 1.0, 2.0])
+    linear = 1.5 * (temperature + 2) / 10 - 0.5 * (temperature * nitrate + 20) / 260 + 0.8 * (depth == 2)
+    linear += 2.0 * np.maximum(nitrate - 5, 0) / 25 - 1.25 - np.log(300)
+    newdata = {"temperature": temperature, "nitrate": nitrate, "depth": depth}
+    assert np.allclose(model.project(newdata, "raw"), np.exp(linear))
+    assert np.allclose(model.project(newdata, "cloglog"), 1 - np.exp(-np.exp(7.5 + linear)))
@@ -0,0 +1,270 @@
+"""Labels points with Southern Ocean frontal zones and sectors without re-reading the zones shapefile"""
+
+import os
+import re
+import json
+import functools
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+import cartopy.crs as ccrs
+from pyproj import Transformer
+from caches import atomic_write
+
+GEOMETRY_CACHE_SUFFIX = ".cache.parquet"
+RASTER_CACHE_SUFFIX = ".raster.cache.npy"
+RASTER_HEADER_SUFFIX = ".raster.cache.json"
+RASTER_CELL_SIZE = 10000  # meters
+# Raster cell values: 0 = not in any zone, 1..n = index of the zone + 1, MIXED_CELL = a zone boundary crosses the cell
+MIXED_CELL = 255
+# Sectors (bins) and their longitude range
+# Ross Sea sector overlaps with the start and end of range: [-180, 180] so it is defined with two split ranges
+SECTOR_BINS = [-180, -130, -60, 20, 90, 160, 180]
+SECTOR_LABELS = ['Ross', 'BA', 'Weddell', 'Indian', 'WPO', 'Ross']
+# NSIDC Southern Hemisphere Grid Coordinates (332 rows x 316 cols). Space between grid cells = 25km
+NSIDC_SHAPE = (332, 316)
+NSIDC_CELL_SIZE = 25000
+NSIDC_X = np.arange(-3950000, +3950000, +NSIDC_CELL_SIZE)
+NSIDC_Y = np.arange(+4350000, -3950000, -NSIDC_CELL_SIZE)
+NSIDC_HEADER_SIZE = 300  # bytes before the grid in NSIDC-0051 files (concentration scaled to 0-250)
+SEA_ICE_THRESHOLD = 15  # percent concentration
+SEA_ICE_ZONE, ICE_FREE_ZONE = "SIZ", "SOZ"
+SEA_ICE_STACK_FILE = "sea_ice_stack.cache.npy"
+SEA_ICE_HEADER_FILE = "sea_ice_stack.cache.json"
+
+
+class ZoneLabeler:
+    """Labels lat/lon arrays with the frontal zones of a zones shapefile (see make_shapefiles.py) and sectors.
+    The zone polygons are projected to SouthPolarStereo and prepared once. They are cached on disk next to the
+    shapefile (keyed by its mtime) so new processes don't parse and reproject the shapefile again.
+    Points are labelled with a zone raster (one lookup per point); only points in raster cells crossed by a zone
+    boundary are tested against the polygons"""
+
+    def __init__(self, zones_shapefile: str, cell_size: float = RASTER_CELL_SIZE):
+        assert os.path.exists(zones_shapefile), "missing frontal zones shapefile; see make_shapefiles.py"
+        self.names, self.zones = load_zones(zones_shapefile)
+        for zone in self.zones:
+            shapely.prepare(zone)
+        self.project = Transformer.from_crs("EPSG:4326", ccrs.SouthPolarStereo(), always_xy=True)
+        self.raster, self.header = load_zone_raster(zones_shapefile, self, cell_size)
+
+    def label_zones(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Zone name of each point (None for points that are not in any zone). Where zones overlap the last zone in
+        shapefile order wins, e.g. SIZ where the sea ice edge is north of the SACCF and SIZ overlaps ASZ"""
+        x, y = self.project.transform(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        return self.label_xy(x, y)
+
+    def label_xy(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Zone name of each SouthPolarStereo point, looked up in the zone raster"""
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        cell = self.header["cell_size"]
+        col = np.floor((x - self.header["x0"]) / cell)
+        row = np.floor((self.header["y0"] - y) / cell)
+        # points outside the raster (or NaN) are outside the bounds of every zone
+        inside = (col >= 0) & (col < self.raster.shape[1]) & (row >= 0) & (row < self.raster.shape[0])
+        codes = np.zeros(len(x), dtype=np.uint8)
+        codes[inside] = self.raster[row[inside].astype(np.intp), col[inside].astype(np.intp)]
+        lookup = np.array([None] + list(self.names), dtype=object)
+        result = lookup[np.minimum(codes, len(self.names))]
+        mixed = np.flatnonzero(codes == MIXED_CELL)
+        result[mixed] = self.label_exact(x[mixed], y[mixed])
+        return result
+
+    def label_exact(self, x: np.ndarray, y: np.ndarray, exclude: tuple = ()) -> np.ndarray:
+        """Zone name of each SouthPolarStereo point, tested against the zone polygons (except the excluded zones)"""
+        result = np.full(len(x), None, dtype=object)
+        unlabelled = np.arange(len(x))
+        for name, zone in zip(reversed(self.names), reversed(self.zones)):
+            if name in exclude:
+                continue
+            inside = shapely.intersects_xy(zone, x[unlabelled], y[unlabelled])
+            result[unlabelled[inside]] = name
+            unlabelled = unlabelled[~inside]
+        return result
+
+    def rasterize(self, cell_size: float) -> tuple[np.ndarray, dict]:
+        """Zone raster covering the bounds of all zones. Cells are labelled by their center and every cell within one
+        cell of a zone boundary is MIXED_CELL"""
+        minx, miny, maxx, maxy = shapely.total_bounds(self.zones)
+        header = {"x0": float(minx), "y0": float(maxy), "cell_size": float(cell_size)}
+        shape = (int(np.ceil((maxy - miny) / cell_size)), int(np.ceil((maxx - minx) / cell_size)))
+        centers_x = minx + (np.arange(shape[1]) + 0.5) * cell_size
+        centers_y = maxy - (np.arange(shape[0]) + 0.5) * cell_size
+        xx, yy = np.meshgrid(centers_x, centers_y)
+        labels = self.label_exact(xx.ravel(), yy.ravel())
+        codes = np.zeros(len(labels), dtype=np.uint8)
+        for i, name in enumerate(self.names):
+            codes[labels == name] = i + 1
+        raster = codes.reshape(shape)
+        # Boundary vertices closer than one cell apart: a cell crossed by a boundary is at most one cell away from one
+        boundary = shapely.get_coordinates(shapely.segmentize(shapely.boundary(self.zones), cell_size / 2))
+        col = np.floor((boundary[:, 0] - minx) / cell_size).astype(np.intp)
+        row = np.floor((maxy - boundary[:, 1]) / cell_size).astype(np.intp)
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                raster[np.clip(row + d_row, 0, shape[0] - 1), np.clip(col + d_col, 0, shape[1] - 1)] = MIXED_CELL
+        return raster, header
+
+    @staticmethod
+    def label_sectors(lon: np.ndarray) -> pd.Categorical:
+        """Sector of each point from its longitude in [-180, 180]"""
+        return pd.cut(lon, bins=SECTOR_BINS, labels=SECTOR_LABELS, ordered=False)
+
+    def label_sea_ice(self, zones: np.ndarray, x: np.ndarray, y: np.ndarray, concentration: np.ndarray) -> np.ndarray:
+        """Replaces the static SIZ (September mean sea ice extent) of zone labels with the sea ice state of each point.
+        Points with ice become SIZ. Points in the static SIZ without ice get the zone they are in without SIZ (SOZ if
+        none). Points with unknown concentration (NaN) keep their label"""
+        zones = zones.copy()
+        known = ~np.isnan(concentration)
+        ice = known & (np.nan_to_num(concentration) >= SEA_ICE_THRESHOLD)
+        zones[ice] = SEA_ICE_ZONE
+        ice_free = np.flatnonzero(known & ~ice & (zones == SEA_ICE_ZONE))
+        without_ice = self.label_exact(x[ice_free], y[ice_free], exclude=(SEA_ICE_ZONE,))
+        zones[ice_free] = np.where(without_ice == None, ICE_FREE_ZONE, without_ice)
+        return zones
+
+    def label(self, df: pd.DataFrame, lat_col: str, lon_col: str, sea_ice: "SeaIceStack" = None,
+              date_col: str = "date_time") -> pd.DataFrame:
+        """Copy of df with front_zone and sector columns. With sea_ice, SIZ is the sea ice state of the month of each
+        point's date_col instead of the September mean"""
+        assert {lon_col, lat_col}.issubset(df.columns), f'"{lon_col}" or "{lat_col}" are not present in the provided DataFrame'
+        assert df[lon_col].between(-180, 180).all(), "Data includes longitudes outside of range [-180, 180]"
+        x, y = self.project.transform(df[lon_col].to_numpy(dtype=float), df[lat_col].to_numpy(dtype=float))
+        zones = self.label_xy(x, y)
+        if sea_ice is not None:
+            zones = self.label_sea_ice(zones, x, y, sea_ice.concentration_xy(x, y, df[date_col]))
+        return df.assign(front_zone=zones, sector=self.label_sectors(df[lon_col]))
+
+
+class SeaIceStack:
+    """Monthly NSIDC sea ice concentration grids of a directory, stacked into one memory-mapped (months x 332 x 316)
+    array. Only the grid pages of the looked up points are read from disk. Grid files are matched to months by the
+    first YYYYMM in their name"""
+
+    def __init__(self, sea_ice_dir: str):
+        assert os.path.isdir(sea_ice_dir), f"{sea_ice_dir} is not a directory of monthly NSIDC grids"
+        self.grids, self.months = load_sea_ice_stack(sea_ice_dir)
+        self.project = Transformer.from_crs("EPSG:4326", ccrs.SouthPolarStereo(), always_xy=True)
+
+    def concentration(self, lat: np.ndarray, lon: np.ndarray, date_time: pd.Series) -> np.ndarray:
+        """Sea ice concentration (percent) at each point in the month of its date_time"""
+        x, y = self.project.transform(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        return self.concentration_xy(x, y, date_time)
+
+    def concentration_xy(self, x: np.ndarray, y: np.ndarray, date_time: pd.Series) -> np.ndarray:
+        """Sea ice concentration (percent) at each SouthPolarStereo point in the month of its date_time.
+        NaN for land, missing data, points outside the grid and months without a grid"""
+        dates = pd.to_datetime(pd.Series(date_time), errors="coerce")
+        month = (dates.dt.year * 12 + dates.dt.month - 1).to_numpy(dtype=float)
+        index = np.searchsorted(self.months, np.nan_to_num(month, nan=-1))
+        index = np.minimum(index, len(self.months) - 1)
+        # Nearest grid cell, same grid coordinates as make_shapefiles.get_sie
+        col = np.round((np.asarray(x) - NSIDC_X[0]) / NSIDC_CELL_SIZE)
+        row = np.round((NSIDC_Y[0] - np.asarray(y)) / NSIDC_CELL_SIZE)
+        valid = ((self.months[index] == month) & (col >= 0) & (col < NSIDC_SHAPE[1]) & (row >= 0) & (row < NSIDC_SHAPE[0]))
+        result = np.full(len(month), np.nan)
+        values = self.grids[index[valid], row[valid].astype(np.intp), col[valid].astype(np.intp)].astype(float)
+        # flags (pole hole, coast, land, missing) are above 100 percent
+        result[valid] = np.where(values <= 100, values, np.nan)
+        return result
+
+
+def read_geometries(shapefile: str) -> gpd.GeoDataFrame:
+    """SouthPolarStereo GeoDataFrame of a shapefile, from the GeoParquet cache next to it when it is up to date.
+    The cache is written the first time the shapefile is read after it changed (keyed by its mtime)"""
+    cache_file = shapefile + GEOMETRY_CACHE_SUFFIX
+    mtime = os.path.getmtime(shapefile)
+    if os.path.exists(cache_file):
+        gdf = gpd.read_parquet(cache_file)
+        if gdf.attrs.get("mtime") == mtime:
+            return gdf
+    gdf = gpd.read_file(shapefile).to_crs(ccrs.SouthPolarStereo())
+    gdf.attrs["mtime"] = mtime
+    with atomic_write(cache_file) as temp_file:
+        gdf.to_parquet(temp_file)
+    return gdf
+
+
+def load_zones(zones_shapefile: str) -> tuple[list[str], list]:
+    """Zone names and SouthPolarStereo geometries of a zones shapefile"""
+    zones_gdf = read_geometries(zones_shapefile)
+    return zones_gdf["front_zone"].tolist(), list(zones_gdf.geometry)
+
+
+def front_coordinates(fronts_shapefile: str) -> dict[str, np.ndarray]:
+    """SouthPolarStereo exterior coordinates (n x 2) of each front of a fronts shapefile, keyed by front name"""
+    fronts_gdf = read_geometries(fronts_shapefile)
+    return {front: shapely.get_coordinates(shapely.get_exterior_ring(geometry))
+            for front, geometry in zip(fronts_gdf["front"], fronts_gdf.geometry)}
+
+
+def load_zone_raster(zones_shapefile: str, labeler: ZoneLabeler, cell_size: float) -> tuple[np.ndarray, dict]:
+    """Memory-mapped zone raster of a zones shapefile and its header (origin and cell size). The raster is stored
+    next to the shapefile and regenerated when the shapefile or the cell size changes"""
+    raster_file, header_file = zones_shapefile + RASTER_CACHE_SUFFIX, zones_shapefile + RASTER_HEADER_SUFFIX
+    mtime = os.path.getmtime(zones_shapefile)
+    if os.path.exists(raster_file) and os.path.exists(header_file):
+        with open(header_file, "r") as file:
+            header = json.load(file)
+        if header["mtime"] == mtime and header["cell_size"] == cell_size:
+            return np.load(raster_file, mmap_mode="r"), header
+    raster, header = labeler.rasterize(cell_size)
+    # the raster is replaced before its header, a header never describes an older raster
+    with atomic_write(raster_file) as temp_file:
+        np.save(temp_file, raster)
+    with atomic_write(header_file) as temp_file, open(temp_file, "w") as file:
+        json.dump(header | {"mtime": mtime}, file)
+    return np.load(raster_file, mmap_mode="r"), header
+
+
+def read_nsidc_grid(path: str) -> np.ndarray:
+    """NSIDC concentration grid as percent (0-100, flags above 100). Raw 332 x 316 grids are percent already,
+    NSIDC-0051 files have a 300 byte header and concentration scaled to 0-250"""
+    grid = np.fromfile(path, dtype=np.uint8)
+    if grid.size == NSIDC_SHAPE[0] * NSIDC_SHAPE[1] + NSIDC_HEADER_SIZE:
+        grid = grid[NSIDC_HEADER_SIZE:]
+        grid = np.where(grid <= 250, np.round(grid / 2.5), grid).astype(np.uint8)
+    return grid.reshape(NSIDC_SHAPE)
+
+
+def load_sea_ice_stack(sea_ice_dir: str) -> tuple[np.ndarray, np.ndarray]:
+    """Memory-mapped stack of the monthly grids in a directory and the month (year * 12 + month - 1) of each grid.
+    The stack is written to the directory one grid at a time and rebuilt when a grid file is added or changed"""
+    stack_file, header_file = os.path.join(sea_ice_dir, SEA_ICE_STACK_FILE), os.path.join(sea_ice_dir, SEA_ICE_HEADER_FILE)
+    files = {}
+    for name in sorted(os.listdir(sea_ice_dir)):
+        match = re.search(r"(19[7-9]\d|20\d\d)(0[1-9]|1[0-2])", name)
+        if match and not name.startswith(("sea_ice_stack", ".")):
+            month = int(match.group(1)) * 12 + int(match.group(2)) - 1
+            assert month not in files, f"{name} and {files.get(month)} are grids of the same month"
+            files[month] = name
+    assert len(files) > 0, f"no monthly NSIDC grids (YYYYMM in file name) found in {sea_ice_dir}"
+    months = sorted(files)
+    sources = [[files[month], os.path.getmtime(os.path.join(sea_ice_dir, files[month]))] for month in months]
+    if os.path.exists(stack_file) and os.path.exists(header_file):
+        with open(header_file, "r") as file:
+            current = json.load(file)["sources"] == sources
+        if current:
+            return np.load(stack_file, mmap_mode="r"), np.array(months)
+    with atomic_write(stack_file) as temp_file:
+        stack = np.lib.format.open_memmap(temp_file, mode="w+", dtype=np.uint8, shape=(len(months), *NSIDC_SHAPE))
+        for i, month in enumerate(months):
+            stack[i] = read_nsidc_grid(os.path.join(sea_ice_dir, files[month]))
+        stack.flush()
+        del stack
+    with atomic_write(header_file) as temp_file, open(temp_file, "w") as file:
+        json.dump({"sources": sources}, file)
+    return np.load(stack_file, mmap_mode="r"), np.array(months)
+
+
+@functools.lru_cache
+def zone_labeler(zones_shapefile: str) -> ZoneLabeler:
+    """ZoneLabeler shared by every caller in this process"""
+    return ZoneLabeler(zones_shapefile)
+
+
+@functools.lru_cache
+def sea_ice_stack(sea_ice_dir: str) -> SeaIceStack:
+    """SeaIceStack shared by every caller in this process"""
+    return SeaIceStack(sea_ice_dir)